@@ -1,11 +1,16 @@
 #!/usr/bin/env python3 -u
 """
 Standalone email poller that runs independently from the web server.
-Checks Gmail every 60 seconds and sends WhatsApp notifications.
+Syncs Gmail when a push notification arrives (or on a slow safety-net poll)
+and sends WhatsApp notifications.
 """
 import os
 import sys
 import time
+import json
+import random
+import threading
+from email.utils import parsedate_to_datetime
 from dotenv import load_dotenv
 
 # Force unbuffered output for systemd logging
@@ -17,128 +22,698 @@ load_dotenv()
 
 # Import services
 from services.gmail_service import GmailService
-from services.ai_service import AIService
+from services.ai_service import AIService, SUMMARY_CACHE_NAMESPACE
 from services.whatsapp_service import WhatsAppService
 from utils.db import Database
+from utils.pipeline import Stage, StagedPipeline
+from utils.outbox import OutboxDispatcher
+from utils.summary_cache import SummaryCache
 
 # Initialize services
 print("🚀 Initializing Aura Agent Email Poller...")
 gmail_service = GmailService()
-ai_service = AIService()
 whatsapp_service = WhatsAppService()
 db = Database()
+# Identical alerts, forwards and newsletters are summarized once
+summary_cache = SummaryCache(
+    db,
+    namespace=SUMMARY_CACHE_NAMESPACE,
+    max_memory_entries=int(os.getenv("SUMMARY_CACHE_MEMORY_ENTRIES", "1024")),
+    ttl_seconds=int(os.getenv("SUMMARY_CACHE_TTL_DAYS", "30")) * 24 * 60 * 60,
+    max_db_entries=int(os.getenv("SUMMARY_CACHE_MAX_ENTRIES", "20000"))
+)
+ai_service = AIService(summary_cache=summary_cache)
 
 SUPERVISOR_WHATSAPP = os.getenv("SUPERVISOR_WHATSAPP")
 
-print(f"✅ Services initialized. Supervisor: {SUPERVISOR_WHATSAPP}")
-print("📧 Starting email polling loop...")
+# Key in the sync_state table holding the last Gmail historyId we fully processed
+HISTORY_ID_KEY = "gmail_history_id"
 
-while True:
-    try:
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Checking for new emails...")
-        unread_emails = gmail_service.list_unread_emails()
-        
-        for email_msg in unread_emails:
-            email_id = email_msg['id']
-            
-            # Check if we've already processed this email
-            existing_thread = db.get_thread_by_email_id(email_id)
-            if existing_thread:
-                continue
+# Page size for Gmail listing/fetching and an optional cap on emails handled per cycle
+PAGE_SIZE = int(os.getenv("GMAIL_PAGE_SIZE", "100"))
+MAX_PER_CYCLE = int(os.getenv("GMAIL_MAX_PER_CYCLE", "0")) or None
+
+# Gmail push notifications (see /webhook/gmail in main.py). With push enabled,
+# polling is only a safety net, so the default interval is much longer.
+PUBSUB_TOPIC = os.getenv("GMAIL_PUBSUB_TOPIC")
+POLL_INTERVAL = int(os.getenv("POLL_INTERVAL_SECONDS", "300" if PUBSUB_TOPIC else "60"))
+PUSH_CHECK_INTERVAL = 1
+
+# Adaptive scheduling: poll faster while mail is arriving, back off when idle or failing
+MIN_POLL_INTERVAL = int(os.getenv("POLL_MIN_INTERVAL_SECONDS", "15"))
+MAX_POLL_INTERVAL = int(os.getenv("POLL_MAX_INTERVAL_SECONDS", str(max(POLL_INTERVAL, 900 if PUBSUB_TOPIC else 300))))
+MAX_ERROR_BACKOFF = int(os.getenv("POLL_MAX_BACKOFF_SECONDS", "900"))
+POLL_JITTER = float(os.getenv("POLL_JITTER", "0.1"))
+# Local hours during which we poll at the slowest rate, e.g. "22-7"
+QUIET_HOURS = os.getenv("QUIET_HOURS")
+WATCH_RENEW_MARGIN = 24 * 60 * 60
+
+# Past this many emails in one cycle, the rest of a backlog is summarized by an
+# OpenAI Batch API job and notified once its results are collected (0 disables)
+SUMMARY_BATCH_API_THRESHOLD = int(os.getenv("SUMMARY_BATCH_API_THRESHOLD", "0"))
+SUMMARY_BATCHES_KEY = "summary_batches"
+
+# Finished threads older than this move to compressed cold storage (0 disables)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_EVERY_SECONDS = 24 * 60 * 60
+
+# Per-stage concurrency for the fetch -> summarize -> store pipeline. Notifications
+# are queued in the outbox with the thread and delivered by the outbox dispatcher.
+FETCH_WORKERS = int(os.getenv("PIPELINE_FETCH_WORKERS", "2"))
+SUMMARIZE_WORKERS = int(os.getenv("PIPELINE_SUMMARIZE_WORKERS", "4"))
+# Emails handed to one summarize call; short ones share a single AI request
+SUMMARIZE_BATCH_SIZE = int(os.getenv("PIPELINE_SUMMARIZE_BATCH_SIZE", "8"))
+SUMMARIZE_BATCH_LINGER = float(os.getenv("PIPELINE_SUMMARIZE_BATCH_LINGER", "0.2"))
+STORE_BATCH_SIZE = int(os.getenv("PIPELINE_STORE_BATCH_SIZE", "50"))
+STORE_BATCH_LINGER = float(os.getenv("PIPELINE_STORE_BATCH_LINGER", "0.5"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "20"))
+
+
+class NewMessagePages:
+    """Lazily trims listing pages to unprocessed messages, at most limit of them in total.
+    
+    The cap counts only new messages, so a capped cycle that didn't advance the sync
+    point makes progress next time instead of re-listing the same stored messages.
+    After iterating, capped tells whether new messages were left for the next cycle.
+    """
+    
+    def __init__(self, pages, limit=None):
+        self.pages = pages
+        self.limit = limit
+        self.capped = False
+    
+    def __iter__(self):
+        remaining = self.limit
+        for page in self.pages:
+            # Skip emails we've already processed
+            new_ids = set(db.filter_new_email_ids([m['id'] for m in page]))
+            new_emails = [m for m in page if m['id'] in new_ids]
             
-            # Get email content
-            email_content = gmail_service.get_email_content(email_id)
+            if remaining is not None and len(new_emails) > remaining:
+                self.capped = True
+                new_emails = new_emails[:remaining]
+            if new_emails:
+                yield new_emails
+            if self.capped:
+                return
+            if remaining is not None:
+                remaining -= len(new_emails)
+
+
+def fetch_new_message_pages():
+    """Get pages of unread messages that arrived since the last sync.
+    
+    Uses Gmail's history API when we have a stored historyId, and falls back to
+    a full `is:unread` resync when there is none or it has expired.
+    Returns (pages, history_id): pages is a lazy NewMessagePages of unprocessed
+    messages, and history_id should only be stored once every page has been
+    processed and pages.capped is False.
+    """
+    start_history_id = db.get_sync_state(HISTORY_ID_KEY)
+    
+    if start_history_id:
+        messages, history_id = gmail_service.list_history(start_history_id)
+        if messages is not None:
+            pages = (messages[i:i + PAGE_SIZE] for i in range(0, len(messages), PAGE_SIZE))
+            return NewMessagePages(pages, MAX_PER_CYCLE), history_id
+        print(f"⚠️ Gmail historyId {start_history_id} expired, running full resync...")
+    
+    # Take the historyId BEFORE listing so nothing arriving mid-listing is missed
+    history_id = gmail_service.get_history_id()
+    print(f"🔄 Full resync of unread emails (historyId {history_id})")
+    # Listing stops as soon as the cap is reached, since pages are requested lazily
+    pages = gmail_service.iter_unread_pages(PAGE_SIZE)
+    return NewMessagePages(pages, MAX_PER_CYCLE), history_id
+
+
+def fetch_page(page):
+    """Pipeline stage: fetch the emails of one page of unprocessed messages.
+    
+    Yields {"msg", "content", "gone"} items; content is None when the fetch failed,
+    and gone is True when the message was deleted from Gmail since it was listed.
+    Raises Gmail's rate limit or server error, if any, once the page's items are out.
+    """
+    # Fetch the page's new emails in batched Gmail requests
+    email_contents, gone, error = gmail_service.get_emails_content([m['id'] for m in page])
+    if gone:
+        print(f"ℹ️ Skipping {len(gone)} emails deleted from Gmail since they were listed")
+    if len(email_contents) + len(gone) < len(page):
+        print(f"⚠️ Fetched {len(email_contents)}/{len(page)} emails, will retry the rest" +
+              (f" ({error})" if error else ""))
+    
+    for email_msg in page:
+        yield {"msg": email_msg, "content": email_contents.get(email_msg['id']), "gone": email_msg['id'] in gone}
+    
+    if error is not None:
+        # After handing on what was fetched, so the poll scheduler backs off (honoring Retry-After)
+        raise error
+
+
+# Emails summarized inline this cycle, for deciding when to defer to the Batch API
+_cycle_summarized = 0
+_cycle_lock = threading.Lock()
+
+
+def summarize_batch(items):
+    """Pipeline stage: summarize a batch of fetched emails with AI.
+    
+    Short emails share one request (see AIService.summarize_emails). Once a cycle is
+    past SUMMARY_BATCH_API_THRESHOLD, emails are marked deferred instead and summarized
+    by a Batch API job after the cycle.
+    """
+    global _cycle_summarized
+    fetched = [item for item in items if item["content"]]
+    
+    with _cycle_lock:
+        inline = len(fetched)
+        if SUMMARY_BATCH_API_THRESHOLD:
+            inline = max(0, min(inline, SUMMARY_BATCH_API_THRESHOLD - _cycle_summarized))
+        _cycle_summarized += inline
+    
+    for item in fetched[inline:]:
+        item["summary"] = None
+        item["deferred"] = True
+    
+    if inline:
+        summaries = ai_service.summarize_emails([
+            {
+                "id": item["msg"]['id'],
+                "sender": item["content"]['sender'],
+                "subject": item["content"]['subject'],
+                "body": item["content"]['body']
+            }
+            for item in fetched[:inline]
+        ])
+        for item in fetched[:inline]:
+            item["summary"] = summaries[item["msg"]['id']]
+    
+    return items
+
+
+def notification_outbox(email_id, sender, subject, summary):
+    """Outbox entry notifying the supervisor about a new email"""
+    return (
+        "whatsapp_notify",
+        {"email_id": email_id, "to": SUPERVISOR_WHATSAPP, "sender": sender, "subject": subject, "summary": summary},
+        f"notify:{email_id}"
+    )
+
+
+def store_batch(items):
+    """Pipeline stage: store a batch of summarized emails in one transaction.
+    
+    Each new thread's supervisor notification is queued in the same transaction, so
+    an email is never stored without its notification (or notified without being stored).
+    Deferred emails are stored as SUMMARIZING and notified once summarized.
+    Yields (email_id, outcome) for every item: "stored", "existing" (stored before),
+    "gone" (deleted from Gmail, nothing to do) or "failed" (retried next cycle).
+    """
+    threads = [
+        {
+            "email_id": item["msg"]['id'],
+            "sender": item["content"]['sender'],
+            "subject": item["content"]['subject'],
+            "body": item["content"]['body'],
+            "summary": item["summary"],
+            "message_id": item["content"].get('message_id'),
+            "references": item["content"].get('references'),
+            "thread_id": item["msg"].get('threadId'),
+            "status": "SUMMARIZING" if item.get("deferred") else "PENDING_REVIEW",
+            "outbox": [] if item.get("deferred") else [notification_outbox(
+                item["msg"]['id'], item["content"]['sender'], item["content"]['subject'], item["summary"]
+            )]
+        }
+        for item in items if item["content"]
+    ]
+    inserted_ids, existing_ids = db.create_threads(threads)
+    if existing_ids:
+        print(f"ℹ️ Skipped {len(existing_ids)} emails that were already stored")
+    if inserted_ids:
+        outbox.wake()
+    
+    inserted_ids = set(inserted_ids)
+    for item in items:
+        if item["content"] is not None:
+            yield item["msg"]['id'], "stored" if item["msg"]['id'] in inserted_ids else "existing"
+        else:
+            yield item["msg"]['id'], "gone" if item["gone"] else "failed"
+
+
+pipeline = StagedPipeline([
+    Stage("fetch", fetch_page, workers=FETCH_WORKERS, fan_out=True),
+    Stage("summarize", summarize_batch, workers=SUMMARIZE_WORKERS, fan_out=True,
+          batch_size=SUMMARIZE_BATCH_SIZE, batch_linger=SUMMARIZE_BATCH_LINGER),
+    Stage("store", store_batch, fan_out=True, batch_size=STORE_BATCH_SIZE, batch_linger=STORE_BATCH_LINGER),
+], queue_size=PIPELINE_QUEUE_SIZE)
+
+
+# Emails whose notification was delivered, marked as read in one batch per cycle.
+# Kept in sync_state so a restart or a failed batchModify can't leave them unread.
+PENDING_MARK_READ_KEY = "gmail_pending_mark_read"
+_mark_read_lock = threading.Lock()
+
+
+def _update_pending_mark_read(add=(), remove=()):
+    with _mark_read_lock:
+        pending = set(json.loads(db.get_sync_state(PENDING_MARK_READ_KEY, "[]")))
+        pending = (pending | set(add)) - set(remove)
+        db.set_sync_state(PENDING_MARK_READ_KEY, json.dumps(sorted(pending)))
+
+
+def send_notification(payload, idempotency_key):
+    """Outbox handler: notify the supervisor about a stored email via WhatsApp.
+    
+    Raises if nothing could be delivered, so the outbox retries it later.
+    """
+    email_id = payload['email_id']
+    summary = payload['summary']
+    
+    # Notify supervisor via WhatsApp using template
+    template_sid = os.getenv("WHATSAPP_TEMPLATE_SID")
+    
+    # FIRST ATTEMPT: Send using Template
+    if template_sid:
+        # Sanitize variables to prevent WhatsApp Template Error 63005
+        # 1. Clean Sender: Revert to standard safe formatting
+        # "Peter Mares <email>" -> "Peter Mares <email>" (if valid chars)
+        clean_sender = payload['sender'].strip()[:50]
             
-            # Summarize with AI
-            summary = ai_service.summarize_email(
-                email_content['subject'],
-                email_content['sender'],
-                email_content['body']
-            )
+        # 2. Clean Subject: Remove newlines, allow only safe chars
+        clean_subject = payload['subject'].replace('\n', ' ').strip()[:50]
             
-            # Store in database
-            db.create_thread(
-                email_id=email_id,
-                sender=email_content['sender'],
-                subject=email_content['subject'],
-                body=email_content['body'],
-                summary=summary,
-                message_id=email_content.get('message_id'),
-                references=email_content.get('references'),
-                thread_id=email_msg.get('threadId')
+        # 3. Clean Summary: MUST remove newlines (Error 21656) but allowed longer length
+        clean_summary = summary.replace('\n', ' ').strip()[:1000]
+        
+        try:
+            whatsapp_service.send_template_message(
+                payload['to'],
+                template_sid,
+                [
+                    clean_sender,      # {{1}}
+                    clean_subject,     # {{2}}
+                    clean_summary      # {{3}}
+                ]
             )
+            print(f"✅ Sent template notification to supervisor: {email_id}")
             
-            
-            # Notify supervisor via WhatsApp using template
-            template_sid = os.getenv("WHATSAPP_TEMPLATE_SID")
-            
-            try:
-                # FIRST ATTEMPT: Send using Template
-                if template_sid:
-                    try:
-                        # Sanitize variables to prevent WhatsApp Template Error 63005
-                        # 1. Clean Sender: Revert to standard safe formatting
-                        # "Peter Mares <email>" -> "Peter Mares <email>" (if valid chars)
-                        clean_sender = email_content['sender'].strip()[:50]
-                            
-                        # 2. Clean Subject: Remove newlines, allow only safe chars
-                        clean_subject = email_content['subject'].replace('\n', ' ').strip()[:50]
-                        
-                        # 3. Clean Summary: MUST remove newlines (Error 21656) but allowed longer length
-                        clean_summary = summary.replace('\n', ' ').strip()[:1000]
-                        
-                        whatsapp_service.send_template_message(
-                            SUPERVISOR_WHATSAPP,
-                            template_sid,
-                            [
-                                clean_sender,      # {{1}}
-                                clean_subject,     # {{2}}
-                                clean_summary      # {{3}}
-                            ]
-                        )
-                        print(f"✅ Sent template notification to supervisor: {email_id}")
-                        
-                    except Exception as template_error:
-                        print(f"⚠️ Template failed ({template_error}), falling back to text message...")
-                        # FALLBACK: Send as standard text message
-                        notification = f"""📨 New Email from {clean_sender}
+        except Exception as template_error:
+            print(f"⚠️ Template failed ({template_error}), falling back to text message...")
+            # FALLBACK: Send as standard text message
+            notification = f"""📨 New Email from {clean_sender}
 Subject: {clean_subject}
 
 {summary}
 
 ---
 Reply with instructions."""
-                        whatsapp_service.send_message(SUPERVISOR_WHATSAPP, notification)
-                        print(f"✅ Sent fallback WhatsApp notification: {email_id}")
-                
-                else:
-                    # No template configured, use standard text
-                    notification = f"""📨 New Email
-From: {email_content['sender']}
-Subject: {email_content['subject']}
+            whatsapp_service.send_message(payload['to'], notification)
+            print(f"✅ Sent fallback WhatsApp notification: {email_id}")
+    
+    else:
+        # No template configured, use standard text
+        notification = f"""📨 New Email
+From: {payload['sender']}
+Subject: {payload['subject']}
 
 {summary}
 
 ---
 Reply with instructions."""
-                    
-                    whatsapp_service.send_message(SUPERVISOR_WHATSAPP, notification)
-                    print(f"✅ Sent WhatsApp notification: {email_id}")
-                
-                # Mark as read in Gmail
-                gmail_service.mark_as_read(email_id)
-                print(f"✅ Marked email as read: {email_id}")
-                
-            except Exception as whatsapp_error:
-                print(f"❌ Failed to send WhatsApp notification: {whatsapp_error}")
-                import traceback
-                traceback.print_exc()
         
-        # Check every 60 seconds
-        time.sleep(60)
+        whatsapp_service.send_message(payload['to'], notification)
+        print(f"✅ Sent WhatsApp notification: {email_id}")
+    
+    # Delivered; the rest is bookkeeping that must not trigger a second notification
+    try:
+        # The supervisor's replies now refer to the email they were just told about
+        db.set_active_thread(payload['to'], email_id)
+    except Exception as e:
+        print(f"⚠️ Failed to update active thread for {email_id}: {e}")
+    try:
+        _update_pending_mark_read(add=[email_id])
+    except Exception as e:
+        print(f"⚠️ Failed to queue {email_id} to be marked as read: {e}")
+
+
+# A notification that can't be delivered can't be reported over WhatsApp either, so
+# notifications never give up: the email stays unread and is retried every max_delay
+# until WhatsApp accepts it
+outbox = OutboxDispatcher(db, {"whatsapp_notify": send_notification}, max_attempts=None)
+
+
+def ensure_watch():
+    """Register or renew the Gmail push watch when it's close to expiring.
+    
+    A failure is logged and retried next cycle; polling keeps running without push.
+    """
+    if not PUBSUB_TOPIC:
+        return
+    
+    expiration = float(db.get_sync_state("gmail_watch_expiration", "0"))
+    if expiration - time.time() > WATCH_RENEW_MARGIN:
+        return
+    
+    try:
+        response = gmail_service.watch(PUBSUB_TOPIC)
+    except Exception as e:
+        # E.g. the topic doesn't exist or gmail-api-push can't publish to it
+        print(f"⚠️ Failed to register Gmail push watch on {PUBSUB_TOPIC}, polling only: {e}")
+        return
+    expiration = int(response['expiration']) / 1000
+    db.set_sync_state("gmail_watch_expiration", str(expiration))
+    print(f"🔔 Gmail push watch active until {time.strftime('%Y-%m-%d %H:%M', time.localtime(expiration))}")
+
+
+class PollScheduler:
+    """Decides how long to wait before the next poll cycle.
+    
+    Halves the interval after a cycle that found mail, grows it by 1.5x after idle
+    cycles, uses the maximum interval during quiet hours, and backs off
+    exponentially on errors (honoring Retry-After on Gmail 429/5xx responses).
+    Every decision is logged and kept in `metrics`.
+    """
+    
+    def __init__(self, base_interval, min_interval, max_interval, max_backoff, jitter=0.1, quiet_hours=None):
+        self.base_interval = base_interval
+        self.min_interval = min(min_interval, base_interval)
+        self.max_interval = max(max_interval, base_interval)
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.quiet_hours = self._parse_quiet_hours(quiet_hours)
+        self.interval = base_interval
+        self.consecutive_errors = 0
+        self.metrics = {
+            "cycles": 0,
+            "emails_processed": 0,
+            "errors": 0,
+            "rate_limited": 0,
+            "last_delay": None,
+            "last_reason": None,
+            "last_decision_at": None
+        }
+    
+    @staticmethod
+    def _parse_quiet_hours(value):
+        if not value:
+            return None
+        start, end = value.split("-")
+        return int(start) % 24, int(end) % 24
+    
+    def in_quiet_hours(self, hour=None):
+        if not self.quiet_hours:
+            return False
+        hour = time.localtime().tm_hour if hour is None else hour
+        start, end = self.quiet_hours
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+    
+    def record_cycle(self, emails_processed):
+        """Return the delay before the next poll after a successful cycle"""
+        self.consecutive_errors = 0
+        self.metrics["cycles"] += 1
+        self.metrics["emails_processed"] += emails_processed
+        
+        if emails_processed:
+            self.interval = max(self.min_interval, self.interval / 2)
+            reason = f"mail arriving ({emails_processed} emails)"
+        else:
+            self.interval = min(self.max_interval, self.interval * 1.5)
+            reason = "idle"
+        
+        if self.in_quiet_hours() and not emails_processed:
+            return self._decide(self.max_interval, "quiet hours")
+        return self._decide(self.interval, reason)
+    
+    def record_error(self, error):
+        """Return the delay before the next poll after a failed cycle"""
+        self.consecutive_errors += 1
+        self.metrics["errors"] += 1
+        
+        status, retry_after = self._error_details(error)
+        backoff = min(self.max_backoff, self.base_interval * 2 ** (self.consecutive_errors - 1))
+        
+        if self.is_throttled(error):
+            self.metrics["rate_limited"] += 1
+            if retry_after is not None:
+                # Retry-After is a floor; never retry sooner than Gmail asked
+                return self._decide(max(retry_after, backoff), f"HTTP {status}, Retry-After {retry_after:.0f}s", jitter=False)
+            return self._decide(backoff, f"HTTP {status}, exponential backoff")
+        return self._decide(backoff, f"error #{self.consecutive_errors}, exponential backoff")
+    
+    def is_throttled(self, error):
+        """Whether an error is a Gmail rate limit or server error worth backing off for"""
+        status, _ = self._error_details(error)
+        return status == 429 or bool(status and status >= 500)
+    
+    @staticmethod
+    def _error_details(error):
+        """Extract (HTTP status, Retry-After seconds) from a Gmail HttpError, if present"""
+        resp = getattr(error, 'resp', None)
+        if resp is None:
+            return None, None
+        
+        status = getattr(resp, 'status', None)
+        retry_after = resp.get('retry-after')
+        if retry_after is None:
+            return status, None
+        try:
+            return status, float(retry_after)
+        except ValueError:
+            # HTTP-date form
+            try:
+                return status, max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                return status, None
+    
+    def _decide(self, delay, reason, jitter=True):
+        if jitter and self.jitter:
+            delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        delay = max(1.0, delay)
+        
+        self.metrics["last_delay"] = round(delay, 1)
+        self.metrics["last_reason"] = reason
+        self.metrics["last_decision_at"] = time.strftime('%Y-%m-%d %H:%M:%S')
+        print(f"⏱️ Next poll in {delay:.0f}s ({reason})")
+        return delay
+
+
+scheduler = PollScheduler(
+    POLL_INTERVAL, MIN_POLL_INTERVAL, MAX_POLL_INTERVAL, MAX_ERROR_BACKOFF,
+    jitter=POLL_JITTER, quiet_hours=QUIET_HOURS
+)
+
+
+def publish_metrics():
+    """Store scheduler, summary cache and outbox metrics where the web server's /metrics endpoint can read them"""
+    try:
+        metrics = dict(scheduler.metrics)
+        metrics["summary_cache"] = dict(summary_cache.stats, hit_rate=round(summary_cache.hit_rate, 3))
+        metrics["outbox"] = dict(outbox.stats)
+        metrics["ai_usage"] = ai_service.usage
+        db.set_sync_state("poller_metrics", json.dumps(metrics))
+    except Exception as e:
+        print(f"⚠️ Failed to store poller metrics: {e}")
+
+
+def maybe_archive():
+    """Move old finished threads to cold storage, at most once a day"""
+    if not ARCHIVE_AFTER_DAYS:
+        return
+    
+    last_run = float(db.get_sync_state("archive_last_run", "0"))
+    if time.time() - last_run < ARCHIVE_EVERY_SECONDS:
+        return
+    
+    stats = db.archive_finished_threads(ARCHIVE_AFTER_DAYS)
+    db.set_sync_state("archive_last_run", str(time.time()))
+    if stats["archived"]:
+        print(f"🗄️ Archived {stats['archived']} threads, reclaimed {stats['reclaimed_bytes'] / 1024:.0f} KiB "
+              f"({stats['raw_bytes'] / 1024:.0f} KiB -> {stats['stored_bytes'] / 1024:.0f} KiB)")
+
+
+_last_push_request = None
+
+
+def wait_for_next_cycle(timeout):
+    """Sleep until the next poll is due or the web server records a Gmail push.
+    
+    Returns True if woken by a push notification.
+    """
+    global _last_push_request
+    deadline = time.monotonic() + timeout
+    
+    while True:
+        requested_at = db.get_sync_state("gmail_sync_requested_at")
+        if requested_at and requested_at != _last_push_request:
+            _last_push_request = requested_at
+            return True
+        
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(PUSH_CHECK_INTERVAL, remaining))
+
+
+def mark_notified_as_read():
+    """Mark emails notified since the last cycle (plus earlier failures) as read in Gmail"""
+    email_ids = json.loads(db.get_sync_state(PENDING_MARK_READ_KEY, "[]"))
+    if not email_ids:
+        return
+    
+    results = gmail_service.mark_as_read_many(email_ids)
+    failed = {email_id for email_id, succeeded in results.items() if not succeeded}
+    # Notifications delivered meanwhile stay pending for the next cycle
+    _update_pending_mark_read(remove=set(results) - failed)
+    
+    print(f"✅ Marked {len(results) - len(failed)} emails as read" + (f", {len(failed)} to retry" if failed else ""))
+
+
+def complete_deferred_summaries(summaries):
+    """Store summaries of SUMMARIZING threads ({email_id: summary}) and queue their notifications"""
+    threads = {t['email_id']: t for t in db.get_threads_awaiting_summary()}
+    completed = db.complete_summaries([
+        {
+            "email_id": email_id,
+            "summary": summary,
+            "outbox": [notification_outbox(email_id, threads[email_id]['sender'], threads[email_id]['subject'], summary)]
+        }
+        for email_id, summary in summaries.items() if email_id in threads
+    ])
+    if completed:
+        outbox.wake()
+    return completed
+
+
+def summarize_deferred_inline(threads):
+    """Summarize SUMMARIZING threads right away and queue their notifications"""
+    if not threads:
+        return
+    summaries = ai_service.summarize_emails([
+        {"id": t['email_id'], "sender": t['sender'], "subject": t['subject'], "body": t['body']}
+        for t in threads
+    ])
+    print(f"📝 Summarized {len(complete_deferred_summaries(summaries))} deferred emails inline")
+
+
+def process_deferred_summaries():
+    """Submit deferred emails as a Batch API job, collect finished jobs, and summarize any stragglers.
+    
+    Pending jobs are kept in sync_state so they survive restarts. Emails a job didn't
+    cover (failed requests, a failed submit, a crash before submitting) are summarized
+    inline, so nothing stays SUMMARIZING forever.
+    """
+    batches = json.loads(db.get_sync_state(SUMMARY_BATCHES_KEY, "[]"))
+    
+    for batch in list(batches):
+        summaries = ai_service.collect_summary_batch(batch['id'])
+        if summaries is None:
+            continue
+        completed = complete_deferred_summaries(summaries)
+        print(f"📦 Summary batch {batch['id']} finished: {len(completed)}/{len(batch['email_ids'])} emails summarized")
+        batches.remove(batch)
+        # Save now, so a crash below can't make us collect this batch twice
+        db.set_sync_state(SUMMARY_BATCHES_KEY, json.dumps(batches))
+        
+        # Whatever the job failed on (or all of it, if it failed, expired or was cancelled)
+        # is summarized inline rather than resubmitted, so a bad job can't loop
+        left_over = set(batch['email_ids']) - set(completed)
+        if left_over:
+            summarize_deferred_inline([t for t in db.get_threads_awaiting_summary() if t['email_id'] in left_over])
+    
+    awaiting = db.get_threads_awaiting_summary()
+    in_flight = {email_id for batch in batches for email_id in batch['email_ids']}
+    unsubmitted = [t for t in awaiting if t['email_id'] not in in_flight]
+    
+    if SUMMARY_BATCH_API_THRESHOLD and len(unsubmitted) >= SUMMARY_BATCH_API_THRESHOLD:
+        try:
+            batch_id = ai_service.submit_summary_batch([
+                {"id": t['email_id'], "sender": t['sender'], "subject": t['subject'], "body": t['body']}
+                for t in unsubmitted
+            ])
+            batches.append({"id": batch_id, "email_ids": [t['email_id'] for t in unsubmitted]})
+            print(f"📦 Submitted {len(unsubmitted)} backlog emails as summary batch {batch_id}")
+            unsubmitted = []
+        except Exception as e:
+            print(f"⚠️ Failed to submit summary batch ({e}), summarizing inline")
+    
+    db.set_sync_state(SUMMARY_BATCHES_KEY, json.dumps(batches))
+    
+    if unsubmitted:
+        summarize_deferred_inline(unsubmitted)
+
+
+def run_cycle():
+    """Run one poll cycle through the pipeline and advance the sync point if it fully succeeded.
+    
+    Returns (emails newly stored, last stage error or None).
+    """
+    global _cycle_summarized
+    pages, history_id = fetch_new_message_pages()
+    
+    _cycle_summarized = 0
+    started = time.monotonic()
+    results = pipeline.run(pages)
+    elapsed = time.monotonic() - started
+    
+    # Failed fetches and emails stored before aren't new mail, so they don't speed polling up
+    stored = sum(1 for _, outcome in results if outcome == "stored")
+    if results:
+        print(f"📊 Stored {stored}/{len(results)} emails in {elapsed:.1f}s {pipeline.stats}")
+        summarize_stats = pipeline.stats["summarize"]
+        if summarize_stats["busy_seconds"]:
+            # Per worker; compare with PIPELINE_SUMMARIZE_BATCH_SIZE=1 for the per-email path
+            scheduler.metrics["summarize_emails_per_second"] = round(
+                summarize_stats["processed"] / summarize_stats["busy_seconds"], 2
+            )
+    
+    # Emails beyond the cap, failed fetches and failed stages are retried next cycle
+    # (emails deleted from Gmail are not), so only advance the sync point once the
+    # whole batch has been handled.
+    # Stored emails are safe: their notifications are in the outbox.
+    mark_notified_as_read()
+    
+    failed = any(outcome == "failed" for _, outcome in results)
+    if not (pages.capped or pipeline.errors or failed) and history_id:
+        db.set_sync_state(HISTORY_ID_KEY, str(history_id))
+    
+    # Backlog emails summarized by a Batch API job (or left over from one)
+    process_deferred_summaries()
+    
+    return stored, pipeline.last_error
+
+
+print(f"✅ Services initialized. Supervisor: {SUPERVISOR_WHATSAPP}")
+print(f"🧠 Loaded {db.warm_seen_cache()} processed email IDs into the dedup cache")
+# Also delivers notifications left undelivered by a previous run
+outbox.start()
+print("📧 Starting email polling loop...")
+
+# Push requests recorded before startup are covered by the first cycle
+_last_push_request = db.get_sync_state("gmail_sync_requested_at")
+
+while True:
+    try:
+        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Checking for new emails...")
+        ensure_watch()
+        processed, stage_error = run_cycle()
+        maybe_archive()
+        
+        # One bad email shouldn't slow polling down, but rate limits should
+        if stage_error is not None and scheduler.is_throttled(stage_error):
+            delay = scheduler.record_error(stage_error)
+        else:
+            delay = scheduler.record_cycle(processed)
+        publish_metrics()
+        
+        # Wait for a push notification, or poll again once the delay is up
+        if wait_for_next_cycle(delay):
+            print("📬 Woken by Gmail push notification")
         
     except Exception as e:
         print(f"❌ Error checking emails: {e}")
         import traceback
         traceback.print_exc()
-        time.sleep(60)
+        # Don't let push notifications cut an error backoff short
+        time.sleep(scheduler.record_error(e))
+        publish_metrics()
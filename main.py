@@ -1,12 +1,19 @@
-from fastapi import FastAPI, Request, BackgroundTasks
+from fastapi import FastAPI, Request, HTTPException
+from starlette.concurrency import run_in_threadpool
 from dotenv import load_dotenv
 import uvicorn
 import os
 import time
+import json
+import base64
+import hashlib
 from services.gmail_service import GmailService
-from services.ai_service import AIService
+from services.ai_service import AIService, ResponseStreamParser, SEND_SIGNAL
 from services.whatsapp_service import WhatsAppService
 from utils.db import Database
+from utils.actors import KeyedSerialExecutor
+from utils.outbox import OutboxDispatcher
+from utils.context import ConversationContext, find_latest_draft
 
 import sys
 
@@ -20,17 +27,33 @@ app = FastAPI()
 
 # Initialize services
 gmail_service = GmailService()
-ai_service = AIService()
+# Turns that don't write a draft go to the small model unless TURN_ROUTING=0
+ai_service = AIService(routing=os.getenv("TURN_ROUTING", "1") != "0")
 whatsapp_service = WhatsAppService()
 db = Database()
 
 # Supervisor's WhatsApp number (you'll need to add this to .env)
 SUPERVISOR_WHATSAPP = os.getenv("SUPERVISOR_WHATSAPP")
 
+# Messages for one email thread are handled in order; different threads run in parallel.
+# A coalesce window > 0 merges messages sent in quick succession into a single AI turn.
+CONVERSATION_WORKERS = int(os.getenv("CONVERSATION_WORKERS", "8"))
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW_SECONDS", "0"))
+
+# Recent turns go to the model verbatim; older ones are folded into a rolling summary
+conversation_context = ConversationContext(
+    keep_turns=int(os.getenv("CONTEXT_KEEP_TURNS", "6")),
+    max_tokens=int(os.getenv("CONTEXT_MAX_TOKENS", "6000"))
+)
+
 @app.post("/webhook/whatsapp")
 @app.post("/webhook/49b779dd-95a5-423b-8cbc-4daf91af44c8/webhook")
 async def whatsapp_webhook(request: Request):
-    """Handle incoming WhatsApp messages from supervisor"""
+    """Handle incoming WhatsApp messages from supervisor.
+    
+    Acknowledges Twilio immediately; the OpenAI/Twilio/Gmail/database work runs on
+    worker threads so slow calls never block the event loop.
+    """
     # Log RAW request details for debugging
     headers = dict(request.headers)
     body = await request.body()
@@ -49,16 +72,72 @@ async def whatsapp_webhook(request: Request):
         return {"status": "error", "message": "Missing From number"}
 
     print(f"Received WhatsApp message: {incoming_msg} from {from_number}")
+    # Queued per sender so messages are routed to their thread in arrival order
+    message_router.submit(from_number, incoming_msg)
     
-    # Get the most recent pending thread
-    pending_threads = db.get_pending_threads()
+    return {"status": "ok"}
+
+def route_supervisor_messages(from_number, messages):
+    """Router handler: dispatch a sender's messages in the order they arrived"""
+    for incoming_msg in messages:
+        dispatch_supervisor_message(incoming_msg, from_number)
+
+def dispatch_supervisor_message(incoming_msg, from_number):
+    """Route a supervisor message to the actor of the email thread it's about"""
+    # Get the thread this supervisor is working on (most recent pending by default)
+    thread = db.get_active_thread(from_number)
     
-    if not pending_threads:
+    if not thread:
         whatsapp_service.send_message(from_number, "No pending emails right now. You're all caught up! 👍")
-        return {"status": "ok"}
+        return
+    
+    conversation_actors.submit(thread['email_id'], (incoming_msg, from_number))
+
+def handle_thread_messages(email_id, messages):
+    """Actor handler: process one or more (coalesced) supervisor messages for a thread.
+    
+    Runs serially per email thread, so the read-modify-write of the conversation
+    history below can't race with another message for the same thread.
+    """
+    thread = db.get_conversation_thread(email_id)
+    if not thread or thread['status'] != "PENDING_REVIEW":
+        # The thread was sent while these messages waited; route them to the next one
+        for incoming_msg, from_number in messages:
+            dispatch_supervisor_message(incoming_msg, from_number)
+        return
+    
+    if len(messages) > 1:
+        print(f"🧵 Coalesced {len(messages)} messages for {email_id} into one turn")
+    incoming_msg = "\n".join(msg for msg, _ in messages)
+    from_number = messages[-1][1]
+    
+    handle_supervisor_message(thread, incoming_msg, from_number)
+    # After replying, so summarizing never delays the supervisor's answer
+    fold_conversation(email_id)
+
+def fold_conversation(email_id):
+    """Summarize turns that left the verbatim window into the thread's rolling summary"""
+    thread = db.get_conversation_thread(email_id)
+    if not thread or thread['status'] != "PENDING_REVIEW":
+        return
     
-    # Work with the most recent thread
-    thread = pending_threads[0]
+    history = db.get_conversation_history(email_id)
+    summarized_upto = thread['summarized_upto']
+    to_fold = conversation_context.pending_fold(history, summarized_upto)
+    if not to_fold:
+        return
+    
+    try:
+        rolling_summary = ai_service.summarize_conversation(thread['rolling_summary'], to_fold)
+    except Exception as e:
+        # Not fatal: the turns are still in the database and get folded next time
+        print(f"⚠️ Failed to summarize conversation for {email_id}: {e}")
+        return
+    db.update_rolling_summary(email_id, rolling_summary, summarized_upto + len(to_fold))
+    print(f"🧾 Folded {len(to_fold)} messages of {email_id} into its rolling summary")
+
+def handle_supervisor_message(thread, incoming_msg, from_number):
+    """Reply to a supervisor message about one email thread (blocking)"""
     email_id = thread['email_id']
     
     # Get email context
@@ -68,73 +147,208 @@ async def whatsapp_webhook(request: Request):
         "body": thread['body']
     }
     
-    # Get conversation history
+    # Get conversation history, fitted to the token budget
     conversation_history = db.get_conversation_history(email_id)
+    context_messages = conversation_context.build(
+        conversation_history, thread['rolling_summary'], thread['summarized_upto']
+    )
+    
+    # Questions and approvals don't need the large model
+    route, reason = ai_service.route_turn(incoming_msg, conversation_history)
+    print(f"🧭 Routed turn for {email_id} as {route} ({reason})")
     
-    # Get AI response (Single Brain)
+    # Stream the AI response (Single Brain), acting on a finished draft or an approval
+    # as soon as it arrives instead of after the whole reply
+    parser = ResponseStreamParser()
+    started = time.monotonic()
+    first_action_at = None
+    sent_upto = 0  # How much of the reply already went out on WhatsApp
     try:
-        response = ai_service.get_response(incoming_msg, email_context, conversation_history)
-        print(f"DEBUG: AI Response: {response}")
+        for chunk in ai_service.stream_response(incoming_msg, email_context, context_messages, route):
+            for event in parser.feed(chunk):
+                if event == "send":
+                    print("🚀 Send signal detected!")
+                    # The marker ends the reply, so what's unsent so far is the confirmation
+                    confirmation = parser.text[sent_upto:].replace(SEND_SIGNAL, "").strip()
+                    # We look through the full history (including the current response) for a --- block
+                    _, draft_body = find_latest_draft(
+                        conversation_history + [{"role": "assistant", "content": parser.text}]
+                    )
+                    queue_reply(thread, draft_body, from_number, confirmation)
+                elif event == "draft" and not parser.send_signal:
+                    # Show the draft while the model is still writing the rest
+                    whatsapp_service.send_message(from_number, parser.text[sent_upto:parser.draft_end].strip())
+                    sent_upto = parser.draft_end
+                if first_action_at is None:
+                    first_action_at = time.monotonic()
+                    print(f"⏱️ First action ({event}) after {first_action_at - started:.1f}s")
     except Exception as e:
         print(f"❌ Error getting AI response: {e}")
-        whatsapp_service.send_message(from_number, "Sorry, I'm having trouble thinking right now. 🧠❌")
-        return {"status": "error"}
+        if first_action_at is None:
+            whatsapp_service.send_message(from_number, "Sorry, I'm having trouble thinking right now. 🧠❌")
+            return
+        # Already acted on part of the reply; keep what we got
+    
+    response = parser.text
+    print(f"DEBUG: AI Response: {response}")
 
     # Update conversation history with user message and AI response
-    conversation_history.append({"role": "user", "content": incoming_msg})
-    conversation_history.append({"role": "assistant", "content": response})
-    db.update_conversation(email_id, conversation_history)
-
-    # Check for SEND SIGNAL
-    if "[SIGNAL: SEND_EMAIL]" in response:
-        print("🚀 Send signal detected!")
-        # Clean the response for WhatsApp (remove the signal marker)
-        whatsapp_msg = response.replace("[SIGNAL: SEND_EMAIL]", "").strip()
-        
-        # Find the most recent draft in history
-        # We look through history (including the current response) for a --- block
-        draft_body = None
-        import re
-        
-        # Search backwards through messages starting from the current one
-        for msg in reversed(conversation_history):
-            content = msg['content']
-            # Find content between --- markers
-            # Matches --- followed by anything (non-greedy) followed by ---
-            match = re.search(r'---\s*(.*?)\s*---', content, re.DOTALL)
-            if match:
-                draft_body = match.group(1).strip()
-                break
-        
-        if draft_body:
-            try:
-                gmail_service.send_email(
-                    to=thread['sender'],
-                    subject=f"Re: {thread['subject']}",
-                    body=draft_body,
-                    in_reply_to=thread.get('message_id'),
-                    references=thread.get('email_references'),
-                    thread_id=thread.get('thread_id')
-                )
-                gmail_service.mark_as_read(email_id)
-                db.update_status(email_id, "SENT")
-                db.update_draft_response(email_id, draft_body) # Keep track of what we sent
-                
-                # Send the AI's chat response (the "Done! Sent." part)
-                whatsapp_service.send_message(from_number, whatsapp_msg)
-                print(f"✅ Email sent successfully using draft: {draft_body[:50]}...")
-            except Exception as send_error:
-                print(f"❌ Error sending email: {send_error}")
-                whatsapp_service.send_message(from_number, f"❌ I tried to send it, but hit an error: {str(send_error)}")
-        else:
-            whatsapp_service.send_message(from_number, "I was ready to send, but I couldn't find the draft in our conversation. Can you show it to me again?")
-            print("⚠️ Send signal detected but no '---' block found in history.")
+    new_messages = [
+        {"role": "user", "content": incoming_msg},
+        {"role": "assistant", "content": response}
+    ]
+    db.append_messages(email_id, new_messages)
+    conversation_history.extend(new_messages)
+
+    # Check for SEARCH SIGNAL (switch to another email)
+    search_query, _ = ai_service.extract_search_query(response)
+    if search_query:
+        print(f"🔎 Search signal detected: {search_query}")
+        _, chat_msg = ai_service.extract_search_query(response[sent_upto:])
+        switch_thread(from_number, search_query, chat_msg)
+        return
+
+    # The send signal was handled while streaming
+    if parser.send_signal:
+        return
+    
+    # Just a normal conversation turn (or what followed an early-sent draft)
+    remainder = response[sent_upto:].strip()
+    if remainder:
+        whatsapp_service.send_message(from_number, remainder)
+    print(f"✅ Conversational reply sent to {from_number} in {time.monotonic() - started:.1f}s")
+
+def queue_reply(thread, draft_body, from_number, confirmation):
+    """Queue the approved draft for sending; the supervisor gets confirmation once Gmail accepts it"""
+    email_id = thread['email_id']
+    if not draft_body:
+        whatsapp_service.send_message(from_number, "I was ready to send, but I couldn't find the draft in our conversation. Can you show it to me again?")
+        print("⚠️ Send signal detected but no '---' block found in history.")
+        return
+    
+    # Recorded durably with the SENDING status; the outbox delivers it (with
+    # retries) and confirms on WhatsApp once Gmail accepted it. The key makes
+    # approving the same draft twice send it once.
+    draft_hash = hashlib.sha256(draft_body.encode()).hexdigest()[:16]
+    queued = db.queue_email_send(email_id, draft_body, {
+        "email_id": email_id,
+        "to": thread['sender'],
+        "subject": f"Re: {thread['subject']}",
+        "body": draft_body,
+        "in_reply_to": thread.get('message_id'),
+        "references": thread.get('email_references'),
+        "thread_id": thread.get('thread_id'),
+        "notify": from_number,
+        "confirmation": confirmation or "✅ Sent."
+    }, f"send:{email_id}:{draft_hash}")
+    if not queued:
+        whatsapp_service.send_message(from_number, "That exact draft has already been sent (or is being sent right now), so I didn't send it again.")
+        print(f"⚠️ Send of {email_id} not queued: draft {draft_hash} already sent or in progress")
+        return
+    outbox.wake()
+    print(f"📤 Queued email send using draft: {draft_body[:50]}...")
+
+def switch_thread(from_number, search_query, chat_msg):
+    """Search all emails and point the supervisor's conversation at the best pending match"""
+    results = db.search_threads(search_query, limit=5)
+    
+    if not results:
+        whatsapp_service.send_message(from_number, f"🔎 I couldn't find any email matching \"{search_query}\".")
+        return
+    
+    # Only pending emails can be discussed and replied to; the rest are listed for reference
+    target = next((r for r in results if r['status'] == "PENDING_REVIEW"), None)
+    lines = [chat_msg] if chat_msg else []
+    if target:
+        db.set_active_thread(from_number, target['email_id'])
+        lines.append(f"🔎 Switched to: {target['sender']}\nSubject: {target['subject']}\n\"{target['snippet']}\"")
+        others = [r for r in results if r is not target]
     else:
-        # Just a normal conversation turn
-        whatsapp_service.send_message(from_number, response)
-        print(f"✅ Conversational reply sent to {from_number}")
+        lines.append("🔎 I found these, but they've already been handled:")
+        others = results
+    
+    for r in others:
+        state = "archived" if r['archived'] else r['status'].replace("_", " ").lower()
+        lines.append(f"• {r['sender']} — {r['subject']} ({state})")
+    
+    whatsapp_service.send_message(from_number, "\n".join(lines))
+    print(f"✅ Search for '{search_query}' -> {target['email_id'] if target else 'no pending match'}")
 
-    return {"status": "ok"}
+def deliver_email_send(payload, idempotency_key):
+    """Outbox handler: send an approved reply through Gmail.
+    
+    Only send_email may raise: anything after it runs once Gmail has the email, and a
+    retry would send it again.
+    """
+    email_id = payload['email_id']
+    gmail_service.send_email(
+        to=payload['to'],
+        subject=payload['subject'],
+        body=payload['body'],
+        in_reply_to=payload.get('in_reply_to'),
+        references=payload.get('references'),
+        thread_id=payload.get('thread_id')
+    )
+    print(f"✅ Email sent successfully using draft: {payload['body'][:50]}...")
+    
+    try:
+        db.update_status(email_id, "SENT")
+        # Send the AI's chat response (the "Done! Sent." part)
+        db.enqueue_outbox("whatsapp_text", {"to": payload['notify'], "body": payload['confirmation']},
+                          f"{idempotency_key}:confirm")
+        gmail_service.mark_as_read(email_id)
+    except Exception as e:
+        print(f"⚠️ Email {email_id} was sent, but follow-up bookkeeping failed: {e}")
+
+def deliver_whatsapp_text(payload, idempotency_key):
+    """Outbox handler: send a plain WhatsApp message"""
+    whatsapp_service.send_message(payload['to'], payload['body'])
+
+def handle_dead_delivery(kind, payload, error):
+    """Tell the supervisor when an email could not be sent, and reopen the thread"""
+    if kind != "gmail_send":
+        return
+    db.update_status(payload['email_id'], "PENDING_REVIEW")
+    db.enqueue_outbox("whatsapp_text", {
+        "to": payload['notify'],
+        "body": f"❌ I tried to send it, but hit an error: {error}"
+    }, f"send-failed:{payload['email_id']}:{time.time()}")
+
+outbox = OutboxDispatcher(
+    db, {"gmail_send": deliver_email_send, "whatsapp_text": deliver_whatsapp_text},
+    on_dead=handle_dead_delivery
+).start()
+
+message_router = KeyedSerialExecutor(route_supervisor_messages, max_workers=2)
+conversation_actors = KeyedSerialExecutor(
+    handle_thread_messages, max_workers=CONVERSATION_WORKERS, coalesce_window=COALESCE_WINDOW
+)
+
+@app.post("/webhook/gmail")
+async def gmail_push_webhook(request: Request):
+    """Handle Gmail push notifications delivered by a Pub/Sub push subscription.
+    
+    The poller picks the request up within a second and runs an incremental sync,
+    so new mail no longer waits for the next slow poll.
+    """
+    # Optional shared secret, configured as ?token=... on the push subscription URL
+    push_token = os.getenv("GMAIL_PUSH_TOKEN")
+    if push_token and request.query_params.get("token") != push_token:
+        raise HTTPException(status_code=403, detail="Invalid token")
+    
+    try:
+        envelope = await request.json()
+        notification = json.loads(base64.b64decode(envelope["message"]["data"]))
+        history_id = str(notification["historyId"])
+    except Exception as e:
+        # Acknowledge anyway: Pub/Sub would keep redelivering a malformed message
+        print(f"⚠️ Ignoring malformed Gmail push notification: {e}")
+        return {"status": "ignored"}
+    
+    print(f"📬 Gmail push for {notification.get('emailAddress')} (historyId {history_id})")
+    await run_in_threadpool(db.set_sync_state, "gmail_sync_requested_at", str(time.time()))
+    
+    return {"status": "ok", "historyId": history_id}
 
 @app.get("/")
 async def root():
@@ -144,6 +358,16 @@ async def root():
 async def health():
     return {"status": "healthy"}
 
+@app.get("/metrics")
+def metrics():
+    """Expose the poller's latest metrics and this process's OpenAI usage and turn routing"""
+    poller_metrics = db.get_sync_state("poller_metrics")
+    return {
+        "poller": json.loads(poller_metrics) if poller_metrics else None,
+        "ai_usage": ai_service.usage,
+        "turn_routes": ai_service.route_metrics()
+    }
+
 
 
 if __name__ == "__main__":
@@ -1,40 +1,30 @@
 import os
+import re
+import json
+import time
+import statistics
+import threading
+from collections import deque
+from string import Template
 from openai import OpenAI
+from utils.context import count_tokens, find_latest_draft, DRAFT_PATTERN
 
-class AIService:
-    def __init__(self):
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    
-    def summarize_email(self, subject, sender, body):
-        """Summarize an email for the supervisor"""
-        prompt = f"""Email from: {sender}
-Subject: {subject}
+# Markers the model appends to trigger actions
+SEND_SIGNAL = "[SIGNAL: SEND_EMAIL]"
+SEARCH_SIGNAL_PATTERN = re.compile(r'\[SIGNAL: SEARCH:\s*(.*?)\]')
 
-Body:
-{body}
+SUMMARY_MODEL = "gpt-4o-mini"
+CONVERSATION_MODEL = "gpt-4o"
+# Bump when the summary prompt changes so cached summaries aren't reused
+SUMMARY_PROMPT_VERSION = 1
+SUMMARY_CACHE_NAMESPACE = f"{SUMMARY_MODEL}:v{SUMMARY_PROMPT_VERSION}"
 
-Provide a sharp, concise summary (2-3 sentences max):
-- Sender's intent
-- Key facts
-- Action items or expectations
-
-No opinions. No invented details. Just the facts."""
-
-        response = self.client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are Amy, a concise and highly competent AI email assistant. Be smart, sharp, and efficient. No fluff, no drama. Capture only what matters."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.5,
-            max_tokens=150
-        )
-        
-        return response.choices[0].message.content
-    
-    def get_response(self, message, email_context, conversation_history):
-        """Unified conversational brain for chatting and drafting"""
-        system_prompt = f"""You are Amy, Peter's highly competent and warm AI Assistant. 
+# Prompts are laid out static-first: the system messages below never change, so every
+# request shares a byte-identical prefix that the provider can serve from its prompt
+# cache. Per-email context comes next (stable across the turns of one thread), then
+# the conversation, which only grows at the end. Keep anything variable out of these
+# constants, or every request misses the cache.
+PERSONA_PROMPT = """You are Amy, Peter's highly competent and warm AI Assistant. 
 You help Peter manage his emails via WhatsApp.
 
 PERSONALITY & TONE:
@@ -67,15 +57,396 @@ CONVERSATION RULES:
 TRIGGERING ACTIONS:
 - If Peter confirms he is happy with a draft and wants to send it (e.g., "send it", "looks good", "GO"), you MUST append the exact marker `[SIGNAL: SEND_EMAIL]` to the very end of your message.
 - If the send signal is present, the system will automatically send the content of the **most recent** `---` block found in the conversation history. Ensure the most recent block contains the final, correct version Peter approved.
+- If Peter asks to find or switch to a different email (e.g., "find the email from Sarah about pricing"), reply with a short acknowledgement and append `[SIGNAL: SEARCH: <keywords>]` with the sender names and topic words to search for. The system will search all emails and switch the conversation to the best match.
+"""
+
+EMAIL_CONTEXT_TEMPLATE = Template("""RECIPIENT CONTEXT:
+Original Email From: $sender
+Subject: $subject
+Body: $body
+
+Remember: You are Peter's EA. You are talking to Peter, but drafting for $sender.""")
 
-RECIPIENT CONTEXT:
-Original Email From: {email_context['sender']}
-Subject: {email_context['subject']}
-Body: {email_context['body']}
+SUMMARY_SYSTEM_PROMPT = "You are Amy, a concise and highly competent AI email assistant. Be smart, sharp, and efficient. No fluff, no drama. Capture only what matters."
 
-Remember: You are Peter's EA. You are talking to Peter, but drafting for {email_context['sender']}."""
+SUMMARY_TEMPLATE = Template("""Email from: $sender
+Subject: $subject
+
+Body:
+$body
+
+Provide a sharp, concise summary (2-3 sentences max):
+- Sender's intent
+- Key facts
+- Action items or expectations
+
+No opinions. No invented details. Just the facts.""")
+
+BATCH_SUMMARY_SYSTEM_PROMPT = SUMMARY_SYSTEM_PROMPT + " Always reply with a JSON object."
+
+BATCH_SUMMARY_TEMPLATE = Template("""Summarize each email below for the supervisor.
+
+For each email, provide a sharp, concise summary (2-3 sentences max):
+- Sender's intent
+- Key facts
+- Action items or expectations
+
+No opinions. No invented details. Just the facts. Never mix up facts between emails.
+
+Reply with {"summaries": [{"id": "<email id>", "summary": "<summary>"}]}, one entry per email.
+
+$emails""")
+
+BATCH_SUMMARY_EMAIL_TEMPLATE = Template("""=== EMAIL $id ===
+Email from: $sender
+Subject: $subject
+
+Body:
+$body""")
+
+# Backlog packing: only short emails share a request, so one long email can't crowd out the rest
+BATCH_SUMMARY_MAX_EMAILS = 10
+BATCH_SUMMARY_MAX_EMAIL_TOKENS = 1000
+BATCH_SUMMARY_MAX_TOKENS = 6000
+
+CONVERSATION_SUMMARY_SYSTEM_PROMPT = "You keep running notes of a conversation between Peter and his email assistant Amy. Be precise and brief."
+
+CONVERSATION_SUMMARY_TEMPLATE = Template("""Summary so far:
+$previous_summary
+
+New conversation turns:
+$transcript
+
+Update the summary so it covers the whole conversation (5-8 sentences max):
+- Peter's instructions and decisions, including anything he rejected
+- Facts and preferences he gave for the reply
+- Drafts proposed and how they changed
+
+Keep exact names, dates, numbers and wording Peter insisted on. No invented details.""")
+
+# Conversation turn kinds -> (model, max_tokens). Only writing a draft needs the
+# large model and a long reply; answers and approvals are short.
+TURN_ROUTES = {
+    "draft": (CONVERSATION_MODEL, 800),
+    "edit": (CONVERSATION_MODEL, 800),
+    "question": (SUMMARY_MODEL, 300),
+    "approval": (SUMMARY_MODEL, 200),
+}
+
+# An approval is a whole message made only of approval phrases ("Looks good, send it!");
+# anything else, such as "send me the pricing sheet", is not one
+_APPROVAL_WORDS = (
+    r"ok(ay)?|yes|yep|yeah|sure|great|perfect|good|fine|approved?|lgtm|go|go ahead|good to go|"
+    r"send( it| that)?( now)?|ship it|looks (good|great|fine)|👍|✅"
+)
+_APPROVAL_PHRASE = rf"({_APPROVAL_WORDS})"
+# Politeness may follow an approval but isn't one on its own ("Thanks!")
+_APPROVAL_EXTRA = rf"({_APPROVAL_WORDS}|thanks|thank you|please)"
+APPROVAL_PATTERN = re.compile(rf"{_APPROVAL_PHRASE}([\s,.!]+{_APPROVAL_EXTRA})*[\s,.!]*", re.IGNORECASE)
+NEGATION_PATTERN = re.compile(r"\b(no|not|don'?t|do not|wait|hold|stop|never)\b|n't\b", re.IGNORECASE)
+EDIT_PATTERN = re.compile(
+    r"\b(change|make it|shorter|longer|more (formal|casual|friendly)|less|add|remove|drop|replace|"
+    r"instead|rephrase|reword|rewrite|tweak|fix|mention|include|tone|but)\b",
+    re.IGNORECASE
+)
+DRAFT_REQUEST_PATTERN = re.compile(
+    r"\b(draft|reply|respond|write|answer|tell (him|her|them)|let (him|her|them) know|decline|accept|"
+    r"confirm|follow up|thank (him|her|them))\b",
+    re.IGNORECASE
+)
+QUESTION_PATTERN = re.compile(
+    r"\?\s*$|^(who|what|when|where|why|how|which|is|are|did|does|do|can|could|find|search|show|switch)\b"
+    r"|^(thanks|thank you|thx|cheers|hi|hello|hey)\b",
+    re.IGNORECASE
+)
+
+# Recent reply latencies kept per route for the median
+ROUTE_LATENCY_WINDOW = 200
+
+class AIService:
+    def __init__(self, summary_cache=None, routing=True):
+        """
+        Args:
+            summary_cache: Optional SummaryCache (utils.summary_cache) consulted before
+                summarizing, built with namespace=SUMMARY_CACHE_NAMESPACE
+            routing: Send conversation turns that don't write a draft to the small model
+                (see route_turn); when False every turn uses the "draft" route
+        """
+        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.summary_cache = summary_cache
+        self._usage_lock = threading.Lock()
+        # Prompt tokens served from the provider's prompt cache, per model
+        self.usage = {}
+        self.routing = routing
+        self._route_latencies = {route: deque(maxlen=ROUTE_LATENCY_WINDOW) for route in TURN_ROUTES}
+        self._route_counts = {route: 0 for route in TURN_ROUTES}
+    
+    def _complete(self, **kwargs):
+        """Create a chat completion and record its prompt cache usage"""
+        response = self.client.chat.completions.create(**kwargs)
+        self._record_usage(kwargs['model'], getattr(response, 'usage', None))
+        return response
+    
+    def _record_usage(self, model, usage):
+        if usage is None:
+            return
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached = (getattr(details, 'cached_tokens', None) or 0) if details is not None else 0
+        with self._usage_lock:
+            stats = self.usage.setdefault(model, {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0})
+            stats["requests"] += 1
+            stats["prompt_tokens"] += usage.prompt_tokens
+            stats["cached_tokens"] += cached
+    
+    def summarize_email(self, subject, sender, body):
+        """Summarize an email for the supervisor, reusing the summary of an identical email"""
+        cache_key = None
+        if self.summary_cache:
+            cache_key = self.summary_cache.key(sender, subject, body)
+            cached = self.summary_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        summary = self._summarize_uncached(subject, sender, body)
+        if cache_key:
+            self.summary_cache.put(cache_key, summary)
+        return summary
+    
+    def _summarize_uncached(self, subject, sender, body):
+        """Summarize one email with a request of its own, bypassing the summary cache"""
+        response = self._complete(**self._summary_request(sender, subject, body))
+        return response.choices[0].message.content
+    
+    @staticmethod
+    def _summary_request(sender, subject, body):
+        """Chat completion arguments for summarizing one email"""
+        return {
+            "model": SUMMARY_MODEL,
+            "messages": [
+                {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                {"role": "user", "content": SUMMARY_TEMPLATE.substitute(sender=sender, subject=subject, body=body)}
+            ],
+            "temperature": 0.5,
+            "max_tokens": 150
+        }
+    
+    def summarize_emails(self, emails):
+        """Summarize a backlog of emails with as few requests as possible.
+        
+        emails: dicts with id, sender, subject and body. Short emails are packed several
+        to a JSON-mode request; long ones, and any the model skipped, get a request
+        of their own. Returns {id: summary}.
+        """
+        summaries = {}
+        uncached = []
+        for email in emails:
+            cached = None
+            if self.summary_cache:
+                email['cache_key'] = self.summary_cache.key(email['sender'], email['subject'], email['body'])
+                cached = self.summary_cache.get(email['cache_key'])
+            if cached is not None:
+                summaries[email['id']] = cached
+            else:
+                uncached.append(email)
+        
+        singles = []
+        for pack in self._pack_emails(uncached, singles):
+            try:
+                packed = self._summarize_pack(pack)
+            except Exception as e:
+                print(f"⚠️ Packed summary of {len(pack)} emails failed ({e}), summarizing them one by one")
+                packed = {}
+            for email in pack:
+                if packed.get(email['id']):
+                    summaries[email['id']] = packed[email['id']]
+                    if self.summary_cache:
+                        self.summary_cache.put(email['cache_key'], packed[email['id']])
+                else:
+                    singles.append(email)
+        
+        # Already looked up in the cache above, so don't go through summarize_email
+        for email in singles:
+            summary = self._summarize_uncached(email['subject'], email['sender'], email['body'])
+            summaries[email['id']] = summary
+            if self.summary_cache:
+                self.summary_cache.put(email['cache_key'], summary)
+        return summaries
+    
+    @staticmethod
+    def _pack_emails(emails, singles):
+        """Group short emails into packs within the size limits; long ones are added to singles"""
+        pack, pack_tokens = [], 0
+        for email in emails:
+            tokens = count_tokens(email['body'])
+            if tokens > BATCH_SUMMARY_MAX_EMAIL_TOKENS:
+                singles.append(email)
+                continue
+            if pack and (len(pack) >= BATCH_SUMMARY_MAX_EMAILS or pack_tokens + tokens > BATCH_SUMMARY_MAX_TOKENS):
+                yield pack
+                pack, pack_tokens = [], 0
+            pack.append(email)
+            pack_tokens += tokens
+        if len(pack) > 1:
+            yield pack
+        else:
+            # A pack of one is just a slower single request
+            singles.extend(pack)
+    
+    def _summarize_pack(self, pack):
+        """Summarize several short emails in one JSON-mode request. Returns {id: summary}."""
+        emails = "\n\n".join(
+            BATCH_SUMMARY_EMAIL_TEMPLATE.substitute(id=email['id'], sender=email['sender'],
+                                                    subject=email['subject'], body=email['body'])
+            for email in pack
+        )
+        response = self._complete(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": BATCH_SUMMARY_SYSTEM_PROMPT},
+                {"role": "user", "content": BATCH_SUMMARY_TEMPLATE.substitute(emails=emails)}
+            ],
+            response_format={"type": "json_object"},
+            temperature=0.5,
+            max_tokens=150 * len(pack) + 100
+        )
+        
+        result = json.loads(response.choices[0].message.content)
+        ids = {email['id'] for email in pack}
+        return {
+            str(entry['id']): entry['summary'].strip()
+            for entry in result.get('summaries', [])
+            if isinstance(entry, dict) and str(entry.get('id')) in ids and isinstance(entry.get('summary'), str)
+        }
+    
+    def submit_summary_batch(self, emails):
+        """Queue summaries for a large backlog as an OpenAI Batch API job (cheaper, finishes within 24h).
+        
+        emails: dicts with id, sender, subject and body. Returns the batch ID for collect_summary_batch.
+        """
+        lines = [
+            json.dumps({
+                "custom_id": email['id'],
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": self._summary_request(email['sender'], email['subject'], email['body'])
+            })
+            for email in emails
+        ]
+        batch_file = self.client.files.create(file=("summaries.jsonl", "\n".join(lines).encode()), purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        return batch.id
+    
+    def collect_summary_batch(self, batch_id):
+        """Return None while a summary batch is still running, else {id: summary} for the emails it summarized.
+        
+        A batch that failed, expired or was cancelled returns whatever it did summarize
+        (often nothing); the caller handles the rest.
+        """
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status in ("validating", "in_progress", "finalizing", "cancelling"):
+            return None
+        
+        if batch.status != "completed" or getattr(batch, 'error_file_id', None):
+            errors = getattr(batch, 'errors', None)
+            print(f"⚠️ Summary batch {batch_id} ended {batch.status} "
+                  f"(error_file_id {getattr(batch, 'error_file_id', None)}, errors {errors})")
+        
+        summaries = {}
+        if batch.output_file_id:
+            for line in self.client.files.content(batch.output_file_id).text.splitlines():
+                result = json.loads(line)
+                response = result.get('response') or {}
+                if response.get('status_code') == 200:
+                    summary = response['body']['choices'][0]['message']['content']
+                    summaries[result['custom_id']] = summary
+        return summaries
+    
+    def summarize_conversation(self, previous_summary, messages):
+        """Fold older conversation turns into a thread's rolling summary"""
+        transcript = "\n\n".join(
+            f"{'Peter' if msg['role'] == 'user' else 'Amy'}: {msg['content']}" for msg in messages
+        )
+        prompt = CONVERSATION_SUMMARY_TEMPLATE.substitute(
+            previous_summary=previous_summary or "(none)", transcript=transcript
+        )
 
-        messages = [{"role": "system", "content": system_prompt}]
+        response = self._complete(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": CONVERSATION_SUMMARY_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.2,
+            max_tokens=300
+        )
+        
+        return response.choices[0].message.content
+    
+    def route_turn(self, message, conversation_history):
+        """Classify a supervisor message as "question", "draft", "edit" or "approval".
+        
+        A local heuristic, so routing adds no latency. Anything ambiguous goes to
+        "draft", which uses the large model. Returns (route, reason).
+        """
+        if not self.routing:
+            return "draft", "routing disabled"
+        
+        text = message.strip()
+        _, draft = find_latest_draft(conversation_history)
+        words = len(text.split())
+        
+        if draft and EDIT_PATTERN.search(text):
+            return "edit", "change requested to the current draft"
+        if draft and words <= 8 and APPROVAL_PATTERN.fullmatch(text) and not NEGATION_PATTERN.search(text):
+            return "approval", "short approval of the current draft"
+        if DRAFT_REQUEST_PATTERN.search(text):
+            return "draft", "asks for a reply"
+        if QUESTION_PATTERN.search(text):
+            return "question", "question or small talk"
+        return "draft", "no clear match"
+    
+    def get_response(self, message, email_context, conversation_history, route="draft"):
+        """Unified conversational brain for chatting and drafting.
+        
+        conversation_history is what the model should see of the conversation; see
+        utils.context.ConversationContext for fitting long threads into a budget.
+        route picks the model and reply length (see route_turn).
+        """
+        started = time.monotonic()
+        response = self._complete(**self._response_request(message, email_context, conversation_history, route))
+        self._record_route(route, time.monotonic() - started)
+        return response.choices[0].message.content
+    
+    def stream_response(self, message, email_context, conversation_history, route="draft"):
+        """Like get_response, but yields the reply's text as it is generated.
+        
+        Feed the chunks to a ResponseStreamParser to act on drafts and signals early.
+        """
+        started = time.monotonic()
+        request = self._response_request(message, email_context, conversation_history, route)
+        stream = self.client.chat.completions.create(**request, stream=True, stream_options={"include_usage": True})
+        for chunk in stream:
+            # The final chunk carries usage and no choices
+            self._record_usage(request['model'], getattr(chunk, 'usage', None))
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+        self._record_route(route, time.monotonic() - started)
+    
+    @staticmethod
+    def _response_request(message, email_context, conversation_history, route="draft"):
+        """Chat completion arguments for a conversation turn"""
+        messages = [
+            {"role": "system", "content": PERSONA_PROMPT},
+            {"role": "system", "content": EMAIL_CONTEXT_TEMPLATE.substitute(
+                sender=email_context['sender'],
+                subject=email_context['subject'],
+                body=email_context['body']
+            )}
+        ]
         
         # Add conversation history
         messages.extend(conversation_history)
@@ -83,11 +454,73 @@ Remember: You are Peter's EA. You are talking to Peter, but drafting for {email_
         # Add the new message
         messages.append({"role": "user", "content": message})
         
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=800
-        )
+        model, max_tokens = TURN_ROUTES[route]
+        return {
+            "model": model,
+            "messages": messages,
+            "temperature": 0.7,
+            "max_tokens": max_tokens
+        }
+    
+    def _record_route(self, route, seconds):
+        with self._usage_lock:
+            self._route_counts[route] += 1
+            self._route_latencies[route].append(seconds)
+        print(f"🧭 {route} turn answered by {TURN_ROUTES[route][0]} in {seconds:.1f}s")
+    
+    def route_metrics(self):
+        """Turns and median/p90 reply latency (seconds, recent turns) per route"""
+        with self._usage_lock:
+            latencies = {route: sorted(values) for route, values in self._route_latencies.items()}
+            counts = dict(self._route_counts)
+        return {
+            route: {
+                "model": TURN_ROUTES[route][0],
+                "turns": counts[route],
+                "median_seconds": round(statistics.median(values), 2) if values else None,
+                "p90_seconds": round(values[int(len(values) * 0.9)], 2) if values else None
+            }
+            for route, values in latencies.items()
+        }
+    
+    @staticmethod
+    def extract_search_query(response):
+        """Return (query, response without the marker) for a search signal, or (None, response)"""
+        match = SEARCH_SIGNAL_PATTERN.search(response)
+        if not match:
+            return None, response
+        return match.group(1).strip(), SEARCH_SIGNAL_PATTERN.sub("", response).strip()
+
+
+class ResponseStreamParser:
+    """Scans a streamed reply for completed --- drafts and the send marker as text arrives.
+    
+    feed() returns the events each chunk completed, so callers can act on a draft or an
+    approval before the rest of the reply has been generated.
+    """
+    
+    def __init__(self):
+        self.text = ""
+        self.draft = None
+        # Index just past the closing --- of the latest draft
+        self.draft_end = 0
+        self.send_signal = False
+    
+    def feed(self, chunk):
+        """Add streamed text. Returns a list of completed events: "draft" and/or "send"."""
+        self.text += chunk
+        events = []
         
-        return response.choices[0].message.content
+        while True:
+            match = DRAFT_PATTERN.search(self.text, self.draft_end)
+            if not match:
+                break
+            self.draft = match.group(1).strip()
+            self.draft_end = match.end()
+            events.append("draft")
+        
+        if not self.send_signal and SEND_SIGNAL in self.text:
+            self.send_signal = True
+            events.append("send")
+        
+        return events
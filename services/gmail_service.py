@@ -1,17 +1,35 @@
 import os
 import base64
+import threading
+import httplib2
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from email.mime.text import MIMEText
+from utils.mime import extract_body
 
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 
+# Gmail allows 100 calls per batch request but recommends 50 to avoid rate limiting
+BATCH_SIZE = 50
+
+# Maximum message IDs accepted by a single batchModify call
+BATCH_MODIFY_SIZE = 1000
+
+# Partial response mask: only the headers and (nested) MIME parts we actually parse
+MESSAGE_FIELDS = 'id,threadId,payload(mimeType,filename,headers(name,value),body/data,parts)'
+
+# Approximate token budget for an email body handed to the AI
+BODY_MAX_TOKENS = int(os.getenv("EMAIL_BODY_MAX_TOKENS", "2000"))
+
 class GmailService:
     def __init__(self):
         self.creds = None
         self.service = None
+        self._local = threading.local()
         self.authenticate()
 
     def authenticate(self):
@@ -42,6 +60,14 @@ class GmailService:
 
         self.service = build('gmail', 'v1', credentials=self.creds)
 
+    def _http(self):
+        """Per-thread authorized HTTP client, since httplib2 connections aren't thread-safe"""
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = AuthorizedHttp(self.creds, http=httplib2.Http())
+            self._local.http = http
+        return http
+
     def _create_credentials_file(self):
         import json
         client_config = {
@@ -58,36 +84,166 @@ class GmailService:
         with open('credentials.json', 'w') as f:
             json.dump(client_config, f)
 
-    def list_unread_emails(self):
-        results = self.service.users().messages().list(userId='me', q='is:unread').execute()
-        messages = results.get('messages', [])
-        return messages
+    def list_unread_emails(self, page_size=100, max_results=None):
+        return [message for page in self.iter_unread_pages(page_size, max_results) for message in page]
+
+    def iter_unread_pages(self, page_size=100, max_results=None):
+        """Lazily yield pages of unread message stubs, following nextPageToken.
+        
+        Each page is only requested once the previous one has been consumed.
+        Stops after max_results messages if given.
+        """
+        page_token = None
+        remaining = max_results
+        
+        while remaining is None or remaining > 0:
+            request_size = page_size if remaining is None else min(page_size, remaining)
+            results = self.service.users().messages().list(
+                userId='me', q='is:unread', maxResults=request_size, pageToken=page_token
+            ).execute(http=self._http())
+            
+            messages = results.get('messages', [])
+            if messages:
+                yield messages
+            if remaining is not None:
+                remaining -= len(messages)
+            
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+
+    def get_history_id(self):
+        """Get the mailbox's current historyId"""
+        profile = self.service.users().getProfile(userId='me').execute(http=self._http())
+        return profile['historyId']
+
+    def watch(self, topic_name, label_ids=('INBOX',)):
+        """Ask Gmail to publish mailbox changes to a Pub/Sub topic.
+        
+        Returns the watch response with 'historyId' and 'expiration' (epoch ms).
+        Watches expire after 7 days and must be renewed.
+        """
+        body = {
+            'topicName': topic_name,
+            'labelIds': list(label_ids),
+            'labelFilterBehavior': 'INCLUDE'
+        }
+        return self.service.users().watch(userId='me', body=body).execute(http=self._http())
+
+    def list_history(self, start_history_id):
+        """List unread messages added to the mailbox since start_history_id.
+        
+        Returns a (messages, history_id) tuple where history_id is the mailbox's
+        latest historyId. Returns (None, None) if start_history_id has expired and
+        a full resync is required.
+        """
+        messages = []
+        seen_ids = set()
+        history_id = None
+        page_token = None
+        
+        while True:
+            try:
+                results = self.service.users().history().list(
+                    userId='me',
+                    startHistoryId=start_history_id,
+                    historyTypes=['messageAdded'],
+                    pageToken=page_token
+                ).execute(http=self._http())
+            except HttpError as e:
+                # Gmail only keeps history for a limited time; 404 means we must resync
+                if e.resp.status == 404:
+                    return None, None
+                raise
+            
+            for record in results.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    message = added['message']
+                    labels = message.get('labelIds', [])
+                    # Mirror the `is:unread` query: skip read, sent, draft, spam and trash messages
+                    if 'UNREAD' not in labels or any(l in labels for l in ('SENT', 'DRAFT', 'SPAM', 'TRASH')):
+                        continue
+                    if message['id'] in seen_ids:
+                        continue
+                    seen_ids.add(message['id'])
+                    messages.append({'id': message['id'], 'threadId': message.get('threadId')})
+            
+            history_id = results.get('historyId', history_id)
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+        
+        return messages, history_id or start_history_id
 
     def get_email_content(self, msg_id):
-        message = self.service.users().messages().get(userId='me', id=msg_id).execute()
+        message = self.service.users().messages().get(
+            userId='me', id=msg_id, format='full', fields=MESSAGE_FIELDS
+        ).execute(http=self._http())
+        return self._parse_message(message)
+
+    def get_emails_content(self, msg_ids):
+        """Fetch and parse many emails using Gmail batch requests.
+        
+        Returns an (emails, gone, error) tuple: emails maps msg_id -> parsed email,
+        gone lists messages Gmail no longer has (404, deleted since they were listed),
+        and error is the first rate limit or server error (HttpError 429/5xx), after
+        which no further batches are sent. Other failures are logged and left out so
+        the caller can retry them.
+        """
+        results = {}
+        gone = []
+        errors = []
+        
+        def on_response(request_id, response, exception):
+            if exception is not None:
+                status = exception.resp.status if isinstance(exception, HttpError) else None
+                if status == 404:
+                    gone.append(request_id)
+                elif status == 429 or (status and status >= 500):
+                    errors.append(exception)
+                else:
+                    print(f"⚠️ Failed to fetch email {request_id}: {exception}")
+                return
+            try:
+                results[request_id] = self._parse_message(response)
+            except Exception as parse_error:
+                print(f"⚠️ Failed to parse email {request_id}: {parse_error}")
+        
+        unique_ids = list(dict.fromkeys(msg_ids))
+        for start in range(0, len(unique_ids), BATCH_SIZE):
+            batch = self.service.new_batch_http_request(callback=on_response)
+            for msg_id in unique_ids[start:start + BATCH_SIZE]:
+                batch.add(
+                    self.service.users().messages().get(
+                        userId='me', id=msg_id, format='full', fields=MESSAGE_FIELDS
+                    ),
+                    request_id=msg_id
+                )
+            batch.execute(http=self._http())
+            if errors:
+                # Back off rather than sending more requests into a rate limit
+                break
+        
+        return results, gone, errors[0] if errors else None
+
+    def _parse_message(self, message):
+        """Extract the fields we use from a Gmail message resource"""
+        msg_id = message['id']
         payload = message['payload']
-        headers = payload.get("headers")
-        subject = next(h['value'] for h in headers if h['name'] == 'Subject')
-        sender = next(h['value'] for h in headers if h['name'] == 'From')
+        headers = payload.get("headers", [])
+        subject = next((h['value'] for h in headers if h['name'] == 'Subject'), "")
+        sender = next((h['value'] for h in headers if h['name'] == 'From'), "")
         
         # Extract threading headers for proper email replies
         message_id = next((h['value'] for h in headers if h['name'] == 'Message-ID'), None)
         references = next((h['value'] for h in headers if h['name'] == 'References'), None)
         
-        parts = payload.get('parts')
-        body = ""
-        if parts:
-            for part in parts:
-                if part['mimeType'] == 'text/plain':
-                    data = part['body']['data']
-                    body = base64.urlsafe_b64decode(data).decode()
-                    break
-        else:
-            data = payload['body']['data']
-            body = base64.urlsafe_b64decode(data).decode()
-            
+        # Bounded, cleaned-up text from nested multiparts or HTML-only mail
+        body = extract_body(payload, BODY_MAX_TOKENS)
+        
         return {
             "id": msg_id,
+            "thread_id": message.get('threadId'),
             "subject": subject,
             "sender": sender,
             "body": body,
@@ -120,7 +276,29 @@ class GmailService:
         if thread_id:
             send_body['threadId'] = thread_id
         
-        self.service.users().messages().send(userId='me', body=send_body).execute()
+        self.service.users().messages().send(userId='me', body=send_body).execute(http=self._http())
 
     def mark_as_read(self, msg_id):
-        self.service.users().messages().modify(userId='me', id=msg_id, body={'removeLabelIds': ['UNREAD']}).execute()
+        self.service.users().messages().modify(userId='me', id=msg_id, body={'removeLabelIds': ['UNREAD']}).execute(http=self._http())
+
+    def mark_as_read_many(self, msg_ids):
+        """Clear UNREAD on many emails using batchModify (up to 1000 IDs per call).
+        
+        Returns a dict of msg_id -> True/False so failed IDs can be retried.
+        """
+        results = {}
+        unique_ids = list(dict.fromkeys(msg_ids))
+        
+        for start in range(0, len(unique_ids), BATCH_MODIFY_SIZE):
+            chunk = unique_ids[start:start + BATCH_MODIFY_SIZE]
+            try:
+                self.service.users().messages().batchModify(
+                    userId='me', body={'ids': chunk, 'removeLabelIds': ['UNREAD']}
+                ).execute(http=self._http())
+                succeeded = True
+            except Exception as e:
+                print(f"⚠️ Failed to mark {len(chunk)} emails as read: {e}")
+                succeeded = False
+            results.update((msg_id, succeeded) for msg_id in chunk)
+        
+        return results
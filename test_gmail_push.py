@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""Post a locally crafted Gmail Pub/Sub push notification to the running web server"""
+import os
+import sys
+import json
+import base64
+import urllib.request
+from dotenv import load_dotenv
+
+load_dotenv()
+
+url = os.getenv("AURA_URL", "http://localhost:8000") + "/webhook/gmail"
+if os.getenv("GMAIL_PUSH_TOKEN"):
+    url += f"?token={os.getenv('GMAIL_PUSH_TOKEN')}"
+
+history_id = sys.argv[1] if len(sys.argv) > 1 else "1"
+
+# Same shape as a real Pub/Sub push delivery
+notification = {"emailAddress": "me@example.com", "historyId": history_id}
+envelope = {
+    "message": {
+        "data": base64.b64encode(json.dumps(notification).encode()).decode(),
+        "messageId": "local-test",
+        "publishTime": "2024-01-01T00:00:00Z"
+    },
+    "subscription": "projects/project-aura/subscriptions/local-test"
+}
+
+request = urllib.request.Request(
+    url,
+    data=json.dumps(envelope).encode(),
+    headers={"Content-Type": "application/json"},
+    method="POST"
+)
+
+try:
+    with urllib.request.urlopen(request) as response:
+        print(f"✅ {response.status}: {response.read().decode()}")
+        print("The poller should start an incremental sync within a second.")
+except Exception as e:
+    print(f"❌ Error posting push notification: {e}")
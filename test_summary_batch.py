@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""Compare backlog summarization throughput: one request per email vs packed requests"""
+import sys
+import time
+from dotenv import load_dotenv
+from services.ai_service import AIService
+
+load_dotenv()
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+# Short, alert-like emails, the typical backlog after downtime
+emails = [
+    {
+        "id": f"test-{i}",
+        "sender": f"alerts{i % 3}@example.com",
+        "subject": f"[Monitoring] Disk usage on server-{i} above {70 + i % 25}%",
+        "body": f"""Hi Peter,
+
+Disk usage on server-{i} reached {70 + i % 25}% at 0{i % 10}:15 UTC.
+Please free up space or expand the volume before it reaches 95%.
+
+Ticket: OPS-{1000 + i}
+Monitoring Team"""
+    }
+    for i in range(count)
+]
+
+ai_service = AIService()
+
+print(f"📝 Summarizing {count} emails one request at a time...")
+started = time.monotonic()
+single = {e['id']: ai_service.summarize_email(e['subject'], e['sender'], e['body']) for e in emails}
+single_elapsed = time.monotonic() - started
+
+print(f"📦 Summarizing {count} emails in packed requests...")
+requests_before = ai_service.usage["gpt-4o-mini"]["requests"]
+started = time.monotonic()
+packed = ai_service.summarize_emails(emails)
+packed_elapsed = time.monotonic() - started
+packed_requests = ai_service.usage["gpt-4o-mini"]["requests"] - requests_before
+
+print(f"\nPer-email: {count} requests, {single_elapsed:.1f}s ({count / single_elapsed:.2f} emails/s)")
+print(f"Packed:    {packed_requests} requests, {packed_elapsed:.1f}s ({count / packed_elapsed:.2f} emails/s)")
+print(f"Speedup:   {single_elapsed / packed_elapsed:.1f}x")
+
+print("\nSample (per-email vs packed):")
+for email in emails[:3]:
+    print(f"\n{email['subject']}\n  1: {single[email['id']]}\n  N: {packed[email['id']]}")
+
+missing = [e['id'] for e in emails if not packed.get(e['id'])]
+if missing:
+    print(f"\n❌ Missing packed summaries: {missing}")
+else:
+    print("\n✅ Every email got a packed summary")
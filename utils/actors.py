@@ -0,0 +1,62 @@
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class KeyedSerialExecutor:
+    """Runs work for the same key strictly in order, and work for different keys in parallel.
+
+    Each key gets its own mailbox; at most one worker drains a mailbox at a time, so
+    handlers for one key never overlap (no lost updates on per-key state). With a
+    coalesce window, messages arriving in quick succession for a key are handed to
+    the handler together.
+    """
+
+    def __init__(self, handler, max_workers=8, coalesce_window=0.0):
+        """
+        Args:
+            handler: Called as handler(key, items) with one item, or with every item
+                that arrived within the coalesce window
+            max_workers: Maximum number of keys processed concurrently
+            coalesce_window: Seconds to wait for more items before handling a key's mailbox
+        """
+        self.handler = handler
+        self.coalesce_window = coalesce_window
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="actor")
+        self._lock = threading.Lock()
+        self._mailboxes = {}
+
+    def submit(self, key, item):
+        """Queue an item for key, starting a worker for it if none is running"""
+        with self._lock:
+            mailbox = self._mailboxes.get(key)
+            if mailbox is not None:
+                # A worker is already draining this key and will pick the item up
+                mailbox.append(item)
+                return
+            self._mailboxes[key] = deque([item])
+        self._executor.submit(self._drain, key)
+
+    def _drain(self, key):
+        while True:
+            if self.coalesce_window:
+                time.sleep(self.coalesce_window)
+
+            with self._lock:
+                mailbox = self._mailboxes[key]
+                if not mailbox:
+                    del self._mailboxes[key]
+                    return
+                if self.coalesce_window:
+                    items = list(mailbox)
+                    mailbox.clear()
+                else:
+                    items = [mailbox.popleft()]
+
+            try:
+                self.handler(key, items)
+            except Exception as e:
+                print(f"❌ Error handling work for {key}: {e}")
+                traceback.print_exc()
@@ -0,0 +1,22 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # Optional: fall back to zlib
+    zstandard = None
+
+
+def compress(data):
+    """Compress bytes with zstd when available, else zlib. Returns (codec, blob)."""
+    if zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=10).compress(data)
+    return 'zlib', zlib.compress(data, 9)
+
+
+def decompress(codec, blob):
+    """Reverse compress() for the given codec"""
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Data is zstd-compressed but the zstandard package isn't installed")
+        return zstandard.ZstdDecompressor().decompress(blob)
+    return zlib.decompress(blob)
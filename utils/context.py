@@ -0,0 +1,104 @@
+import re
+from utils.mime import CHARS_PER_TOKEN
+
+try:
+    import tiktoken
+except ImportError:  # Optional: fall back to a characters-per-token estimate
+    tiktoken = None
+
+# Chat formatting adds a few tokens per message on top of its content
+MESSAGE_OVERHEAD_TOKENS = 4
+
+DRAFT_PATTERN = re.compile(r'---\s*(.*?)\s*---', re.DOTALL)
+
+_encoding = None
+
+
+def count_tokens(text):
+    """Count tokens the way gpt-4o does when tiktoken is installed, else estimate"""
+    global _encoding
+    if tiktoken is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding("o200k_base")
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages):
+    return sum(count_tokens(msg['content']) + MESSAGE_OVERHEAD_TOKENS for msg in messages)
+
+
+def find_latest_draft(messages):
+    """Return (index, draft body) of the most recent message with a --- block, or (None, None)"""
+    for index in range(len(messages) - 1, -1, -1):
+        match = DRAFT_PATTERN.search(messages[index]['content'])
+        if match:
+            return index, match.group(1).strip()
+    return None, None
+
+
+class ConversationContext:
+    """Fits a thread's conversation into a token budget.
+
+    Every message the thread's rolling summary doesn't cover yet is sent verbatim;
+    once more than keep_turns exchanges are pending, pending_fold() hands the oldest
+    ones to be folded into the summary. Unsummarized messages are only dropped when
+    they don't fit max_tokens. The latest --- draft is always kept, even once the message
+    holding it has been summarized, since approving it sends exactly that text.
+    """
+
+    def __init__(self, keep_turns=6, max_tokens=6000, fold_min_messages=4):
+        """
+        Args:
+            keep_turns: Recent user/assistant exchanges never folded into the summary
+            max_tokens: Budget for the history part of the prompt (summary, draft and turns)
+            fold_min_messages: Messages that must have aged out before fold() summarizes them,
+                so summarization runs every few turns rather than after each one
+        """
+        self.keep_turns = keep_turns
+        self.max_tokens = max_tokens
+        self.fold_min_messages = fold_min_messages
+
+    def build(self, history, rolling_summary=None, summarized_upto=0):
+        """Return the messages to send in place of the full history.
+
+        history is the full conversation; summarized_upto is how many of its leading
+        messages rolling_summary covers.
+        """
+        # Messages past the verbatim window stay until they're folded, so none go missing
+        window_start = summarized_upto
+        recent = list(history[window_start:])
+
+        draft_index, draft = find_latest_draft(history)
+        pinned = draft_index is not None and draft_index < window_start
+
+        # Over budget: drop the oldest verbatim messages. The draft's own message is
+        # replaced by the shorter pinned copy of the draft, so the draft always stays.
+        while recent:
+            preamble = self._preamble(rolling_summary, draft if pinned else None)
+            if count_message_tokens(preamble + recent) <= self.max_tokens:
+                break
+            if window_start == draft_index:
+                pinned = True
+            del recent[0]
+            window_start += 1
+
+        if window_start > summarized_upto:
+            print(f"⚠️ Context budget dropped {window_start - summarized_upto} unsummarized messages")
+        return self._preamble(rolling_summary, draft if pinned else None) + recent
+
+    @staticmethod
+    def _preamble(rolling_summary, pinned_draft):
+        preamble = []
+        if rolling_summary:
+            preamble.append({"role": "system", "content": f"Summary of the earlier conversation:\n{rolling_summary}"})
+        if pinned_draft is not None:
+            preamble.append({"role": "system", "content": f"Latest draft proposed earlier:\n---\n{pinned_draft}\n---"})
+        return preamble
+
+    def pending_fold(self, history, summarized_upto=0):
+        """Messages that have left the verbatim window but aren't summarized yet, or [] if too few"""
+        fold_end = len(history) - 2 * self.keep_turns
+        if fold_end - summarized_upto < self.fold_min_messages:
+            return []
+        return history[summarized_upto:fold_end]
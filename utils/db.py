@@ -1,80 +1,275 @@
 import sqlite3
 import json
+import re
+import threading
+import time
 from datetime import datetime
+from utils.compression import compress, decompress
+from utils.migrations import run_migrations
+
+# Stay well below SQLite's bound-parameter limit for IN (...) queries
+MAX_QUERY_PARAMS = 500
+
+# How long a writer waits for another process (web server vs. poller) to release the lock
+BUSY_TIMEOUT_MS = 10000
+
+# Prepared statements kept per connection
+STATEMENT_CACHE_SIZE = 256
+
+# Columns the conversation flow needs from the active thread
+ACTIVE_THREAD_COLUMNS = ('t.email_id, t.sender, t.subject, t.body, t.status, t.message_id, t.email_references, '
+                         't.thread_id, t.rolling_summary, t.summarized_upto')
+
+# Filler words dropped from natural-language search requests
+SEARCH_STOPWORDS = {
+    'a', 'about', 'an', 'and', 'any', 'email', 'emails', 'find', 'for', 'from', 'get', 'i', 'in',
+    'is', 'me', 'message', 'of', 'on', 'one', 'please', 'regarding', 'show', 'that', 'the',
+    'this', 'to', 'was', 'with'
+}
+
+# Relevance weights per email_search column: email_id, sender, subject, body, summary, draft_response
+SEARCH_WEIGHTS = (0.0, 5.0, 4.0, 1.0, 2.0, 1.0)
+
+# Statuses whose threads are finished and may be moved to cold storage
+ARCHIVABLE_STATUSES = ('SENT',)
+
+
+def _snippet(text, terms, size=12):
+    """Up to size words of text around the first search term, with terms marked *like this*"""
+    words = (text or '').split()
+    # Prefix match stands in for the index's stemming ("invoices" finds "invoice")
+    hits = [i for i, w in enumerate(words)
+            if any(re.sub(r'\W', '', w.lower()).startswith(t[:max(4, len(t) - 2)]) for t in terms)]
+    start = max(0, hits[0] - size // 2) if hits else 0
+    marked = [f'*{w}*' if i in hits else w for i, w in enumerate(words[start:start + size], start)]
+    return ('…' if start else '') + ' '.join(marked) + ('…' if start + size < len(words) else '')
+
 
 class Database:
+    # Database files whose schema this process has already brought up to date
+    _migrated_paths = set()
+    _migration_lock = threading.Lock()
+    
     def __init__(self, db_path='aura_agent.db'):
         self.db_path = db_path
+        # One long-lived connection per thread; sqlite3 connections can't be shared across threads
+        self._local = threading.local()
+        # Email IDs known to have a thread row; None until warm_seen_cache() is called
+        self._seen_email_ids = None
         self.init_db()
     
+    def _connect(self):
+        """Get this thread's connection, opening and tuning it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.db_path,
+                timeout=BUSY_TIMEOUT_MS / 1000,
+                cached_statements=STATEMENT_CACHE_SIZE
+            )
+            conn.row_factory = sqlite3.Row
+            # WAL lets readers and a writer (in different processes) work concurrently
+            conn.execute('PRAGMA journal_mode=WAL')
+            # Safe with WAL: a power loss can only drop the last commits, never corrupt
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+            self._local.conn = conn
+        return conn
+    
+    def close(self):
+        """Close this thread's connection"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+    
     def init_db(self):
-        """Initialize the database schema"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        """Bring the database schema up to date.
         
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS email_threads (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                email_id TEXT UNIQUE NOT NULL,
-                sender TEXT NOT NULL,
-                subject TEXT NOT NULL,
-                body TEXT NOT NULL,
-                summary TEXT,
-                status TEXT DEFAULT 'PENDING_REVIEW',
-                conversation_history TEXT,
-                draft_response TEXT,
-                message_id TEXT,
-                email_references TEXT,
-                thread_id TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        Pending migrations run once per database file and process; later Database()
+        constructions skip the DDL entirely.
+        """
+        with Database._migration_lock:
+            if self.db_path in Database._migrated_paths:
+                return
+            run_migrations(self._connect())
+            Database._migrated_paths.add(self.db_path)
+    
+    def create_thread(self, email_id, sender, subject, body, summary, message_id=None, references=None, thread_id=None):
+        """Create a new email thread"""
+        conn = self._connect()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO email_threads (email_id, sender, subject, body, summary, message_id, email_references, thread_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (email_id, sender, subject, body, summary, message_id, references, thread_id))
+            thread_db_id = cursor.lastrowid
+        
+        if self._seen_email_ids is not None:
+            self._seen_email_ids.add(email_id)
+        
+        return thread_db_id
+    
+    def create_threads(self, threads):
+        """Insert many threads in a single transaction, skipping ones that already exist.
         
-        # Add new columns if they don't exist (for existing databases)
-        try:
-            cursor.execute('ALTER TABLE email_threads ADD COLUMN message_id TEXT')
-        except sqlite3.OperationalError:
-            pass  # Column already exists
+        threads: dicts with email_id, sender, subject, body, summary and optionally
+        message_id, references, thread_id, status (default PENDING_REVIEW) and outbox,
+        a list of (kind, payload, idempotency_key) side effects queued in the same
+        transaction if the row is new.
+        Returns (inserted_email_ids, existing_email_ids).
+        """
+        if not threads:
+            return [], []
         
-        try:
-            cursor.execute('ALTER TABLE email_threads ADD COLUMN email_references TEXT')
-        except sqlite3.OperationalError:
-            pass
+        conn = self._connect()
+        with conn:
+            # Take the write lock up front so the rows with id > max_id are exactly ours
+            conn.execute('BEGIN IMMEDIATE')
+            cursor = conn.cursor()
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM email_threads')
+            max_id = cursor.fetchone()[0]
+            
+            cursor.executemany('''
+                INSERT INTO email_threads
+                (email_id, sender, subject, body, summary, status, message_id, email_references, thread_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (email_id) DO NOTHING
+            ''', [(t['email_id'], t['sender'], t['subject'], t['body'], t['summary'], t.get('status', 'PENDING_REVIEW'),
+                   t.get('message_id'), t.get('references'), t.get('thread_id')) for t in threads])
+            
+            cursor.execute('SELECT email_id FROM email_threads WHERE id > ?', (max_id,))
+            inserted = {row[0] for row in cursor.fetchall()}
+            
+            for thread in threads:
+                if thread['email_id'] in inserted:
+                    for kind, payload, idempotency_key in thread.get('outbox', []):
+                        self._enqueue_outbox(cursor, kind, payload, idempotency_key)
         
-        try:
-            cursor.execute('ALTER TABLE email_threads ADD COLUMN thread_id TEXT')
-        except sqlite3.OperationalError:
-            pass
+        if self._seen_email_ids is not None:
+            self._seen_email_ids.update(t['email_id'] for t in threads)
         
-        conn.commit()
-        conn.close()
+        inserted_ids = [t['email_id'] for t in threads if t['email_id'] in inserted]
+        existing_ids = [t['email_id'] for t in threads if t['email_id'] not in inserted]
+        return inserted_ids, existing_ids
     
-    def create_thread(self, email_id, sender, subject, body, summary, message_id=None, references=None, thread_id=None):
-        """Create a new email thread"""
-        conn = sqlite3.connect(self.db_path)
+    def get_threads_awaiting_summary(self, limit=None):
+        """Get threads stored with status SUMMARIZING, oldest first"""
+        conn = self._connect()
         cursor = conn.cursor()
         
         cursor.execute('''
-            INSERT INTO email_threads (email_id, sender, subject, body, summary, conversation_history, message_id, email_references, thread_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (email_id, sender, subject, body, summary, json.dumps([]), message_id, references, thread_id))
+            SELECT email_id, sender, subject, body FROM email_threads
+            WHERE status = 'SUMMARIZING' ORDER BY id LIMIT ?
+        ''', (-1 if limit is None else limit,))
+        return [dict(row) for row in cursor.fetchall()]
+    
+    def complete_summaries(self, threads):
+        """Store summaries for SUMMARIZING threads and move them to PENDING_REVIEW.
+        
+        threads: dicts with email_id, summary and optionally outbox, as for create_threads;
+        side effects are queued only for threads this call completed.
+        Returns the completed email IDs.
+        """
+        completed = []
+        conn = self._connect()
+        with conn:
+            cursor = conn.cursor()
+            for thread in threads:
+                cursor.execute('''
+                    UPDATE email_threads SET summary = ?, status = 'PENDING_REVIEW', updated_at = CURRENT_TIMESTAMP
+                    WHERE email_id = ? AND status = 'SUMMARIZING'
+                ''', (thread['summary'], thread['email_id']))
+                if cursor.rowcount:
+                    completed.append(thread['email_id'])
+                    for kind, payload, idempotency_key in thread.get('outbox', []):
+                        self._enqueue_outbox(cursor, kind, payload, idempotency_key)
+        return completed
+    
+    def warm_seen_cache(self):
+        """Load every processed email ID into memory for fast dedup checks"""
+        conn = self._connect()
+        cursor = conn.cursor()
         
-        thread_db_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        cursor.execute('SELECT email_id FROM email_threads UNION ALL SELECT email_id FROM email_threads_archive')
+        self._seen_email_ids = {row[0] for row in cursor.fetchall()}
         
-        return thread_db_id
+        return len(self._seen_email_ids)
+    
+    def filter_new_email_ids(self, email_ids):
+        """Return the email IDs (in input order) that don't have a thread yet"""
+        candidates = list(dict.fromkeys(email_ids))
+        if self._seen_email_ids is not None:
+            candidates = [e for e in candidates if e not in self._seen_email_ids]
+        if not candidates:
+            return []
+        
+        # The cache only knows about this process's inserts, so confirm with one
+        # indexed lookup per chunk that reads nothing but the email_id column
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        existing = set()
+        for start in range(0, len(candidates), MAX_QUERY_PARAMS // 2):
+            # Each chunk is bound twice (hot and cold table)
+            chunk = candidates[start:start + MAX_QUERY_PARAMS // 2]
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(f'''
+                SELECT email_id FROM email_threads WHERE email_id IN ({placeholders})
+                UNION ALL
+                SELECT email_id FROM email_threads_archive WHERE email_id IN ({placeholders})
+            ''', chunk + chunk)
+            existing.update(row[0] for row in cursor.fetchall())
+        
+        if self._seen_email_ids is not None:
+            self._seen_email_ids.update(existing)
+        
+        return [e for e in candidates if e not in existing]
     
     def get_thread_by_email_id(self, email_id):
         """Get thread by email ID"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+        conn = self._connect()
         cursor = conn.cursor()
         
         cursor.execute('SELECT * FROM email_threads WHERE email_id = ?', (email_id,))
         row = cursor.fetchone()
-        conn.close()
+        
+        if row:
+            return dict(row)
+        # Read through to cold storage for archived threads
+        return self._get_archived_thread(email_id)
+    
+    def _get_archived_thread(self, email_id):
+        """Get an archived thread in the same shape as an email_threads row"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT * FROM email_threads_archive WHERE email_id = ?', (email_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        
+        thread = dict(row)
+        payload = json.loads(decompress(thread.pop('codec'), thread.pop('payload')))
+        thread.pop('raw_size')
+        thread.update(
+            body=payload['body'],
+            summary=payload['summary'],
+            draft_response=payload['draft_response'],
+            conversation_history=None,
+            archived=True,
+            archived_messages=payload['messages']
+        )
+        return thread
+    
+    def get_conversation_thread(self, email_id):
+        """Get only the columns the conversation flow needs for a thread"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute(f'SELECT {ACTIVE_THREAD_COLUMNS} FROM email_threads t WHERE t.email_id = ?', (email_id,))
+        row = cursor.fetchone()
         
         if row:
             return dict(row)
@@ -82,61 +277,421 @@ class Database:
     
     def get_pending_threads(self):
         """Get all threads pending review"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+        conn = self._connect()
         cursor = conn.cursor()
         
-        cursor.execute('SELECT * FROM email_threads WHERE status = "PENDING_REVIEW" ORDER BY id DESC')
+        cursor.execute("SELECT * FROM email_threads WHERE status = 'PENDING_REVIEW' ORDER BY id DESC")
         rows = cursor.fetchall()
-        conn.close()
         
         return [dict(row) for row in rows]
     
-    def update_conversation(self, email_id, conversation_history):
-        """Update conversation history for a thread"""
-        conn = sqlite3.connect(self.db_path)
+    @staticmethod
+    def _supervisor_key(number):
+        """Normalize 'whatsapp:+123', '+123' and '123' to the same key"""
+        return ''.join(ch for ch in (number or '') if ch.isdigit())
+    
+    def get_active_thread(self, supervisor=None):
+        """Get the thread a supervisor is working on.
+        
+        Uses the supervisor's active-thread pointer if it still points at a pending
+        thread, otherwise the most recent pending thread. Returns None if nothing is pending.
+        """
+        conn = self._connect()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            UPDATE email_threads 
-            SET conversation_history = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE email_id = ?
-        ''', (json.dumps(conversation_history), email_id))
+        row = None
+        if supervisor:
+            cursor.execute(f'''
+                SELECT {ACTIVE_THREAD_COLUMNS} FROM active_threads a
+                JOIN email_threads t ON t.email_id = a.email_id
+                WHERE a.supervisor = ? AND t.status = 'PENDING_REVIEW'
+            ''', (self._supervisor_key(supervisor),))
+            row = cursor.fetchone()
         
-        conn.commit()
-        conn.close()
+        if row is None:
+            cursor.execute(f'''
+                SELECT {ACTIVE_THREAD_COLUMNS} FROM email_threads t
+                WHERE t.status = 'PENDING_REVIEW' ORDER BY t.id DESC LIMIT 1
+            ''')
+            row = cursor.fetchone()
+        
+        if row:
+            return dict(row)
+        return None
+    
+    def set_active_thread(self, supervisor, email_id):
+        """Point a supervisor's conversation at a thread"""
+        conn = self._connect()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO active_threads (supervisor, email_id, updated_at)
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(supervisor) DO UPDATE SET email_id = excluded.email_id, updated_at = CURRENT_TIMESTAMP
+            ''', (self._supervisor_key(supervisor), email_id))
+    
+    def update_conversation(self, email_id, conversation_history):
+        """Replace the whole conversation history for a thread (prefer append_messages)"""
+        conn = self._connect()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM conversation_messages WHERE email_id = ?', (email_id,))
+            cursor.executemany('''
+                INSERT INTO conversation_messages (email_id, seq, role, content)
+                VALUES (?, ?, ?, ?)
+            ''', [(email_id, seq, msg['role'], msg['content']) for seq, msg in enumerate(conversation_history, 1)])
+            # The rolling summary described the old history
+            cursor.execute('''
+                UPDATE email_threads SET rolling_summary = NULL, summarized_upto = 0, updated_at = CURRENT_TIMESTAMP
+                WHERE email_id = ?
+            ''', (email_id,))
+    
+    def append_messages(self, email_id, messages):
+        """Append conversation turns ({"role", "content"} dicts) to a thread's history"""
+        conn = self._connect()
+        with conn:
+            cursor = conn.cursor()
+            for msg in messages:
+                # MAX(seq) is answered from the (email_id, seq) unique index
+                cursor.execute('''
+                    INSERT INTO conversation_messages (email_id, seq, role, content)
+                    SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?
+                    FROM conversation_messages WHERE email_id = ?
+                ''', (email_id, msg['role'], msg['content'], email_id))
+            cursor.execute('UPDATE email_threads SET updated_at = CURRENT_TIMESTAMP WHERE email_id = ?', (email_id,))
+    
+    def append_message(self, email_id, role, content):
+        """Append a single conversation turn to a thread's history"""
+        self.append_messages(email_id, [{"role": role, "content": content}])
+    
+    def update_rolling_summary(self, email_id, rolling_summary, summarized_upto):
+        """Store the summary of a thread's first summarized_upto conversation messages"""
+        conn = self._connect()
+        with conn:
+            conn.execute('''
+                UPDATE email_threads SET rolling_summary = ?, summarized_upto = ?
+                WHERE email_id = ?
+            ''', (rolling_summary, summarized_upto, email_id))
     
     def update_draft_response(self, email_id, draft_response):
         """Update draft response for a thread"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE email_threads 
+                SET draft_response = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE email_id = ?
+            ''', (draft_response, email_id))
+    
+    def update_status(self, email_id, status):
+        """Update status of a thread"""
+        conn = self._connect()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE email_threads 
+                SET status = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE email_id = ?
+            ''', (status, email_id))
+    
+    def get_conversation_history(self, email_id, last_k=None):
+        """Get conversation history as list, optionally only the last_k messages"""
+        conn = self._connect()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            UPDATE email_threads 
-            SET draft_response = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE email_id = ?
-        ''', (draft_response, email_id))
+        if last_k is None:
+            cursor.execute('''
+                SELECT role, content FROM conversation_messages
+                WHERE email_id = ? ORDER BY seq
+            ''', (email_id,))
+        else:
+            cursor.execute('''
+                SELECT role, content FROM (
+                    SELECT seq, role, content FROM conversation_messages
+                    WHERE email_id = ? ORDER BY seq DESC LIMIT ?
+                ) ORDER BY seq
+            ''', (email_id, last_k))
+        rows = cursor.fetchall()
+        
+        if not rows:
+            archived = self._get_archived_thread(email_id)
+            if archived:
+                messages = archived['archived_messages']
+                return messages[-last_k:] if last_k else messages
         
-        conn.commit()
-        conn.close()
+        return [{"role": row['role'], "content": row['content']} for row in rows]
     
-    def update_status(self, email_id, status):
-        """Update status of a thread"""
-        conn = sqlite3.connect(self.db_path)
+    def search_threads(self, query, limit=5):
+        """Full-text search over sender, subject, body, summary and draft, best match first.
+        
+        Accepts natural language ("email from Sarah about pricing"): every remaining
+        term must match, falling back to any term. Returns dicts with email_id,
+        sender, subject, snippet, status and archived.
+        """
+        terms = [t for t in re.findall(r'\w+', query.lower()) if t not in SEARCH_STOPWORDS]
+        if not terms:
+            return []
+        
+        conn = self._connect()
         cursor = conn.cursor()
+        weights = ', '.join(str(w) for w in SEARCH_WEIGHTS)
+        # email_search_archive has the same columns minus email_id
+        archive_weights = ', '.join(str(w) for w in SEARCH_WEIGHTS[1:])
         
+        results = []
+        for operator in (' AND ', ' OR '):
+            # Quote every term so user input can't be parsed as FTS syntax
+            match = operator.join(f'"{t}"' for t in terms)
+            cursor.execute(f'''
+                SELECT t.email_id, t.sender, t.subject,
+                       snippet(email_search, 3, '*', '*', '…', 12) AS snippet,
+                       t.status, bm25(email_search, {weights}) AS rank
+                FROM email_search
+                JOIN email_threads t ON t.id = email_search.rowid
+                WHERE email_search MATCH ?
+                ORDER BY rank
+                LIMIT ?
+            ''', (match, limit))
+            results = [dict(row, archived=False) for row in cursor.fetchall()]
+            
+            # The archive index holds no text, so snippets come from the decompressed body
+            cursor.execute(f'''
+                SELECT a.email_id, a.sender, a.subject, a.status, a.codec, a.payload,
+                       bm25(email_search_archive, {archive_weights}) AS rank
+                FROM email_search_archive
+                JOIN email_threads_archive a ON a.rowid = email_search_archive.rowid
+                WHERE email_search_archive MATCH ?
+                ORDER BY rank
+                LIMIT ?
+            ''', (match, limit))
+            for row in cursor.fetchall():
+                body = json.loads(decompress(row['codec'], row['payload']))['body']
+                results.append({
+                    "email_id": row['email_id'], "sender": row['sender'], "subject": row['subject'],
+                    "snippet": _snippet(body, terms), "status": row['status'],
+                    "rank": row['rank'], "archived": True
+                })
+            if results or len(terms) == 1:
+                break
+        
+        results.sort(key=lambda r: r['rank'])
+        for result in results:
+            del result['rank']
+        return results[:limit]
+    
+    def archive_finished_threads(self, older_than_days=30, batch_size=200):
+        """Move finished threads not updated for older_than_days into compressed cold storage.
+        
+        Each batch is moved in one transaction. Archived emails stay searchable through a
+        contentless index (tokens only, no text). Returns stats including the bytes
+        reclaimed from the hot table (raw size minus compressed size).
+        """
+        stats = {"archived": 0, "raw_bytes": 0, "stored_bytes": 0}
+        conn = self._connect()
+        placeholders = ','.join('?' * len(ARCHIVABLE_STATUSES))
+        
+        while True:
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute(f'''
+                    SELECT * FROM email_threads
+                    WHERE status IN ({placeholders}) AND updated_at < datetime('now', ?)
+                    ORDER BY updated_at LIMIT ?
+                ''', (*ARCHIVABLE_STATUSES, f'-{older_than_days} days', batch_size))
+                threads = [dict(row) for row in cursor.fetchall()]
+                if not threads:
+                    break
+                
+                for thread in threads:
+                    email_id = thread['email_id']
+                    messages = self.get_conversation_history(email_id)
+                    raw = json.dumps({
+                        "body": thread['body'],
+                        "summary": thread['summary'],
+                        "draft_response": thread['draft_response'],
+                        "messages": messages
+                    }).encode()
+                    codec, blob = compress(raw)
+                    
+                    cursor.execute('''
+                        INSERT OR REPLACE INTO email_threads_archive
+                        (email_id, sender, subject, status, message_id, email_references, thread_id,
+                         created_at, updated_at, codec, raw_size, payload)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ''', (email_id, thread['sender'], thread['subject'], thread['status'], thread['message_id'],
+                          thread['email_references'], thread['thread_id'], thread['created_at'],
+                          thread['updated_at'], codec, len(raw), blob))
+                    cursor.execute('''
+                        INSERT INTO email_search_archive (rowid, sender, subject, body, summary, draft_response)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ''', (cursor.lastrowid, thread['sender'], thread['subject'], thread['body'],
+                          thread['summary'], thread['draft_response']))
+                    cursor.execute('DELETE FROM conversation_messages WHERE email_id = ?', (email_id,))
+                    cursor.execute('DELETE FROM active_threads WHERE email_id = ?', (email_id,))
+                    cursor.execute('DELETE FROM email_threads WHERE email_id = ?', (email_id,))
+                    
+                    stats["archived"] += 1
+                    stats["raw_bytes"] += len(raw)
+                    stats["stored_bytes"] += len(blob)
+        
+        stats["reclaimed_bytes"] = stats["raw_bytes"] - stats["stored_bytes"]
+        # Pages freed in the file are reused by new rows before the file grows again
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        stats["free_bytes"] = conn.execute('PRAGMA freelist_count').fetchone()[0] * page_size
+        return stats
+    
+    def _enqueue_outbox(self, cursor, kind, payload, idempotency_key):
+        """Queue a side effect inside the caller's transaction; duplicates are ignored"""
         cursor.execute('''
-            UPDATE email_threads 
-            SET status = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE email_id = ?
-        ''', (status, email_id))
-        
-        conn.commit()
-        conn.close()
-    
-    def get_conversation_history(self, email_id):
-        """Get conversation history as list"""
-        thread = self.get_thread_by_email_id(email_id)
-        if thread and thread['conversation_history']:
-            return json.loads(thread['conversation_history'])
-        return []
+            INSERT INTO outbox (idempotency_key, kind, payload, next_attempt_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (idempotency_key) DO NOTHING
+        ''', (idempotency_key, kind, json.dumps(payload), time.time()))
+        return cursor.rowcount == 1
+    
+    def enqueue_outbox(self, kind, payload, idempotency_key):
+        """Queue a side effect for the outbox dispatcher. Returns False if the key was already queued."""
+        conn = self._connect()
+        with conn:
+            return self._enqueue_outbox(conn.cursor(), kind, payload, idempotency_key)
+    
+    def queue_email_send(self, email_id, draft_response, payload, idempotency_key):
+        """Record an approved draft and queue its Gmail send in one transaction.
+        
+        A send that gave up earlier (DEAD) under the same key is queued again with fresh
+        attempts. Returns False, leaving the thread untouched, if the key is already
+        pending, in flight or sent.
+        """
+        conn = self._connect()
+        with conn:
+            cursor = conn.cursor()
+            queued = self._enqueue_outbox(cursor, 'gmail_send', payload, idempotency_key)
+            if not queued:
+                cursor.execute('''
+                    UPDATE outbox SET status = 'PENDING', attempts = 0, next_attempt_at = ?, lease_until = NULL,
+                        last_error = NULL, payload = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE idempotency_key = ? AND status = 'DEAD'
+                ''', (time.time(), json.dumps(payload), idempotency_key))
+                queued = cursor.rowcount == 1
+            
+            if queued:
+                cursor.execute('''
+                    UPDATE email_threads
+                    SET draft_response = ?, status = 'SENDING', updated_at = CURRENT_TIMESTAMP
+                    WHERE email_id = ?
+                ''', (draft_response, email_id))
+            return queued
+    
+    def claim_outbox(self, kinds, limit=10, lease_seconds=120):
+        """Claim due outbox entries of the given kinds for delivery.
+        
+        Claimed entries are leased; if the claiming process dies, they become due again
+        once the lease runs out. Returns dicts with id, kind, payload (decoded),
+        idempotency_key and attempts.
+        """
+        now = time.time()
+        placeholders = ','.join('?' * len(kinds))
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT id, kind, payload, idempotency_key, attempts FROM outbox
+                WHERE kind IN ({placeholders}) AND (
+                    (status = 'PENDING' AND next_attempt_at <= ?)
+                    OR (status = 'IN_FLIGHT' AND lease_until <= ?)
+                )
+                ORDER BY next_attempt_at LIMIT ?
+            ''', (*kinds, now, now, limit))
+            rows = [dict(row) for row in cursor.fetchall()]
+            
+            cursor.executemany('''
+                UPDATE outbox SET status = 'IN_FLIGHT', lease_until = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', [(now + lease_seconds, row['id']) for row in rows])
+        
+        for row in rows:
+            row['payload'] = json.loads(row['payload'])
+        return rows
+    
+    def complete_outbox(self, outbox_id):
+        """Mark an outbox entry as delivered"""
+        conn = self._connect()
+        with conn:
+            conn.execute('''
+                UPDATE outbox SET status = 'DONE', attempts = attempts + 1, lease_until = NULL,
+                    last_error = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (outbox_id,))
+    
+    def fail_outbox(self, outbox_id, error, retry_at=None):
+        """Record a failed delivery: retry at retry_at (epoch seconds), or give up if None"""
+        conn = self._connect()
+        with conn:
+            conn.execute('''
+                UPDATE outbox SET status = ?, attempts = attempts + 1, next_attempt_at = COALESCE(?, next_attempt_at),
+                    lease_until = NULL, last_error = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', ('PENDING' if retry_at is not None else 'DEAD', retry_at, str(error)[:1000], outbox_id))
+    
+    def get_cached_summary(self, key, ttl_seconds):
+        """Return the cached summary for a content key, or None if missing or older than ttl_seconds"""
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT summary FROM summary_cache WHERE key = ? AND created_at > ?',
+                           (key, now - ttl_seconds))
+            row = cursor.fetchone()
+            if row:
+                cursor.execute('UPDATE summary_cache SET last_used_at = ? WHERE key = ?', (now, key))
+        return row[0] if row else None
+    
+    def set_cached_summary(self, key, summary):
+        """Store a summary under its content key"""
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute('''
+                INSERT INTO summary_cache (key, summary, created_at, last_used_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET summary = excluded.summary,
+                    created_at = excluded.created_at, last_used_at = excluded.last_used_at
+            ''', (key, summary, now, now))
+    
+    def prune_summary_cache(self, ttl_seconds, max_entries):
+        """Drop expired summaries, then the least recently used beyond max_entries. Returns rows removed."""
+        conn = self._connect()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM summary_cache WHERE created_at <= ?', (time.time() - ttl_seconds,))
+            removed = cursor.rowcount
+            cursor.execute('''
+                DELETE FROM summary_cache WHERE key IN (
+                    SELECT key FROM summary_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+                )
+            ''', (max_entries,))
+            return removed + cursor.rowcount
+    
+    def get_sync_state(self, key, default=None):
+        """Get a stored sync state value"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT value FROM sync_state WHERE key = ?', (key,))
+        row = cursor.fetchone()
+        
+        if row:
+            return row[0]
+        return default
+    
+    def set_sync_state(self, key, value):
+        """Store a sync state value"""
+        conn = self._connect()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO sync_state (key, value, updated_at)
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP
+            ''', (key, value))
@@ -0,0 +1,340 @@
+import json
+from utils.compression import decompress
+
+# Ordered schema migrations: (version, description, function(cursor)).
+# Each migration runs exactly once per database, inside its own transaction, and is
+# written to be idempotent so databases created before versioning upgrade cleanly.
+# Never edit a released migration; append a new one instead.
+
+
+def _columns(cursor, table):
+    cursor.execute(f'PRAGMA table_info({table})')
+    return {row[1] for row in cursor.fetchall()}
+
+
+def _create_email_threads(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS email_threads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email_id TEXT UNIQUE NOT NULL,
+            sender TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            summary TEXT,
+            status TEXT DEFAULT 'PENDING_REVIEW',
+            conversation_history TEXT,
+            draft_response TEXT,
+            message_id TEXT,
+            email_references TEXT,
+            thread_id TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _add_threading_columns(cursor):
+    # Columns added after the first release, needed for proper email replies
+    existing = _columns(cursor, 'email_threads')
+    for column in ('message_id', 'email_references', 'thread_id'):
+        if column not in existing:
+            cursor.execute(f'ALTER TABLE email_threads ADD COLUMN {column} TEXT')
+
+
+def _create_sync_state(cursor):
+    # Small key/value store for poller state (e.g. the last synced Gmail historyId)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _create_conversation_messages(cursor):
+    # One row per conversation turn, so appending doesn't rewrite the whole history
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (email_id, seq)
+        )
+    ''')
+
+    # Move histories stored as JSON in email_threads into the new table
+    cursor.execute('''
+        SELECT email_id, conversation_history FROM email_threads
+        WHERE conversation_history IS NOT NULL AND conversation_history NOT IN ('', '[]')
+    ''')
+    legacy = cursor.fetchall()
+
+    for email_id, history_json in legacy:
+        cursor.execute('SELECT COUNT(*) FROM conversation_messages WHERE email_id = ?', (email_id,))
+        if cursor.fetchone()[0] == 0:
+            cursor.executemany('''
+                INSERT INTO conversation_messages (email_id, seq, role, content)
+                VALUES (?, ?, ?, ?)
+            ''', [(email_id, seq, msg['role'], msg['content']) for seq, msg in enumerate(json.loads(history_json), 1)])
+        cursor.execute('UPDATE email_threads SET conversation_history = NULL WHERE email_id = ?', (email_id,))
+
+    if legacy:
+        print(f"🗄️ Migrated {len(legacy)} conversation histories to conversation_messages")
+
+
+def _create_active_thread_lookup(cursor):
+    # Newest-pending lookups (WHERE status = ? ORDER BY id DESC) read this index only
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_email_threads_status_id ON email_threads (status, id)')
+
+    # Which thread each supervisor is currently talking about
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS active_threads (
+            supervisor TEXT PRIMARY KEY,
+            email_id TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _create_archive(cursor):
+    # Cold storage for finished threads: metadata stays queryable, while body, summary,
+    # draft and conversation are kept as one compressed JSON payload
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS email_threads_archive (
+            email_id TEXT PRIMARY KEY,
+            sender TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            status TEXT NOT NULL,
+            message_id TEXT,
+            email_references TEXT,
+            thread_id TEXT,
+            created_at TIMESTAMP,
+            updated_at TIMESTAMP,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            codec TEXT NOT NULL,
+            raw_size INTEGER NOT NULL,
+            payload BLOB NOT NULL
+        )
+    ''')
+    # Finds archivable threads without scanning the hot table
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_email_threads_status_updated ON email_threads (status, updated_at)')
+
+
+def _create_search_index(cursor):
+    # Full-text index over hot and archived emails. FTS rowid = email_threads.id, so
+    # triggers find rows by rowid; archived rows keep theirs when the hot row goes away.
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS email_search USING fts5(
+            email_id UNINDEXED, sender, subject, body, summary, draft_response,
+            tokenize = 'porter unicode61'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS email_threads_search_insert AFTER INSERT ON email_threads BEGIN
+            INSERT INTO email_search (rowid, email_id, sender, subject, body, summary, draft_response)
+            VALUES (new.id, new.email_id, new.sender, new.subject, new.body, new.summary, new.draft_response);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS email_threads_search_update
+        AFTER UPDATE OF sender, subject, body, summary, draft_response ON email_threads BEGIN
+            UPDATE email_search SET sender = new.sender, subject = new.subject, body = new.body,
+                summary = new.summary, draft_response = new.draft_response
+            WHERE rowid = new.id;
+        END
+    ''')
+    # Archiving also deletes the hot row, but its search entry must survive
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS email_threads_search_delete AFTER DELETE ON email_threads
+        WHEN NOT EXISTS (SELECT 1 FROM email_threads_archive WHERE email_id = old.email_id) BEGIN
+            DELETE FROM email_search WHERE rowid = old.id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS email_threads_archive_search_delete AFTER DELETE ON email_threads_archive BEGIN
+            DELETE FROM email_search WHERE email_id = old.email_id;
+        END
+    ''')
+
+    # Backfill existing rows
+    cursor.execute('DELETE FROM email_search')
+    cursor.execute('''
+        INSERT INTO email_search (rowid, email_id, sender, subject, body, summary, draft_response)
+        SELECT id, email_id, sender, subject, body, summary, draft_response FROM email_threads
+    ''')
+    cursor.execute('SELECT email_id, sender, subject, codec, payload FROM email_threads_archive')
+    for n, (email_id, sender, subject, codec, blob) in enumerate(cursor.fetchall(), 1):
+        payload = json.loads(decompress(codec, blob))
+        # Negative rowids can never collide with email_threads ids
+        cursor.execute('''
+            INSERT INTO email_search (rowid, email_id, sender, subject, body, summary, draft_response)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (-n, email_id, sender, subject, payload['body'], payload['summary'], payload['draft_response']))
+
+
+def _create_outbox(cursor):
+    # Outbound side effects (WhatsApp notifications, Gmail sends) recorded in the same
+    # transaction as the state change that needs them, then delivered with retries.
+    # Times are epoch seconds so backoff arithmetic stays in Python.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idempotency_key TEXT UNIQUE NOT NULL,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'PENDING',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            lease_until REAL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, kind, next_attempt_at)')
+
+
+def _create_summary_cache(cursor):
+    # Summaries keyed by a hash of the normalized email, so repeated alerts and
+    # forwards don't each cost an LLM call
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS summary_cache (
+            key TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_summary_cache_last_used ON summary_cache (last_used_at)')
+
+
+def _add_rolling_summary_columns(cursor):
+    # Summary of the conversation turns that no longer fit in the prompt, and how many
+    # leading messages it covers
+    existing = _columns(cursor, 'email_threads')
+    if 'rolling_summary' not in existing:
+        cursor.execute('ALTER TABLE email_threads ADD COLUMN rolling_summary TEXT')
+    if 'summarized_upto' not in existing:
+        cursor.execute('ALTER TABLE email_threads ADD COLUMN summarized_upto INTEGER NOT NULL DEFAULT 0')
+
+
+def _slim_search_index(cursor):
+    # email_search stored its own uncompressed copy of every body, summary and draft,
+    # including archived ones, which undid the archive's compression. Hot emails are now
+    # indexed with external content (text is read from email_threads), and archived emails
+    # get a contentless index: tokens only, rowid = email_threads_archive.rowid.
+    for trigger in ('email_threads_search_insert', 'email_threads_search_update',
+                    'email_threads_search_delete', 'email_threads_archive_search_delete'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    cursor.execute('DROP TABLE IF EXISTS email_search')
+    
+    cursor.execute('''
+        CREATE VIRTUAL TABLE email_search USING fts5(
+            email_id UNINDEXED, sender, subject, body, summary, draft_response,
+            content = 'email_threads', content_rowid = 'id',
+            tokenize = 'porter unicode61'
+        )
+    ''')
+    # External content indexes must be told the old values to remove them
+    cursor.execute('''
+        CREATE TRIGGER email_threads_search_insert AFTER INSERT ON email_threads BEGIN
+            INSERT INTO email_search (rowid, email_id, sender, subject, body, summary, draft_response)
+            VALUES (new.id, new.email_id, new.sender, new.subject, new.body, new.summary, new.draft_response);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER email_threads_search_delete AFTER DELETE ON email_threads BEGIN
+            INSERT INTO email_search (email_search, rowid, email_id, sender, subject, body, summary, draft_response)
+            VALUES ('delete', old.id, old.email_id, old.sender, old.subject, old.body, old.summary, old.draft_response);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER email_threads_search_update
+        AFTER UPDATE OF sender, subject, body, summary, draft_response ON email_threads BEGIN
+            INSERT INTO email_search (email_search, rowid, email_id, sender, subject, body, summary, draft_response)
+            VALUES ('delete', old.id, old.email_id, old.sender, old.subject, old.body, old.summary, old.draft_response);
+            INSERT INTO email_search (rowid, email_id, sender, subject, body, summary, draft_response)
+            VALUES (new.id, new.email_id, new.sender, new.subject, new.body, new.summary, new.draft_response);
+        END
+    ''')
+    cursor.execute("INSERT INTO email_search (email_search) VALUES ('rebuild')")
+    
+    # Archived rows are indexed by archive_finished_threads, which has the decompressed text
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS email_search_archive USING fts5(
+            sender, subject, body, summary, draft_response,
+            content = '', tokenize = 'porter unicode61'
+        )
+    ''')
+    cursor.execute('SELECT rowid, sender, subject, codec, payload FROM email_threads_archive')
+    for rowid, sender, subject, codec, blob in cursor.fetchall():
+        payload = json.loads(decompress(codec, blob))
+        cursor.execute('''
+            INSERT INTO email_search_archive (rowid, sender, subject, body, summary, draft_response)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (rowid, sender, subject, payload['body'], payload['summary'], payload['draft_response']))
+
+
+MIGRATIONS = [
+    (1, "create email_threads", _create_email_threads),
+    (2, "add threading columns to email_threads", _add_threading_columns),
+    (3, "create sync_state", _create_sync_state),
+    (4, "move conversation history to conversation_messages", _create_conversation_messages),
+    (5, "add active thread index and pointers", _create_active_thread_lookup),
+    (6, "create email_threads_archive", _create_archive),
+    (7, "create email_search full-text index", _create_search_index),
+    (8, "create outbox", _create_outbox),
+    (9, "create summary_cache", _create_summary_cache),
+    (10, "add rolling summary columns to email_threads", _add_rolling_summary_columns),
+    (11, "index archived emails without storing their text", _slim_search_index),
+]
+
+
+def get_schema_version(conn):
+    """Return the highest applied migration version (0 for a fresh database)"""
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+
+def run_migrations(conn):
+    """Apply pending migrations in order, each in its own transaction.
+
+    BEGIN IMMEDIATE takes the write lock before the version is re-checked, so when
+    the web server and the poller start together only one of them applies each step.
+    Returns the list of versions applied.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+    applied = []
+    for version, description, migrate in MIGRATIONS:
+        if version <= get_schema_version(conn):
+            continue
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if version <= get_schema_version(conn):
+                # Another process got here first
+                conn.rollback()
+                continue
+            migrate(conn.cursor())
+            conn.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)', (version, description))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        print(f"🗄️ Applied schema migration {version}: {description}")
+        applied.append(version)
+
+    return applied
@@ -0,0 +1,159 @@
+import base64
+import re
+from html.parser import HTMLParser
+
+# Rough size of a token for English text, used to turn token budgets into characters
+CHARS_PER_TOKEN = 4
+
+# HTML and quoted replies are mostly thrown away, so decode this many times the
+# text budget before cleaning up
+RAW_BUDGET_FACTOR = 4
+
+TRUNCATION_MARKER = "\n[... truncated]"
+
+# Lines that start a quoted reply chain or a forwarded original
+QUOTE_HEADER_PATTERNS = [
+    re.compile(r'^On .+wrote:\s*$'),
+    re.compile(r'^-{2,}\s*Original Message\s*-{2,}', re.IGNORECASE),
+    re.compile(r'^-{2,}\s*Forwarded message\s*-{2,}', re.IGNORECASE),
+    re.compile(r'^_{20,}\s*$'),  # Outlook separator
+]
+
+# Lines that start a signature block
+SIGNATURE_PATTERNS = [
+    # Exactly "-- " (RFC 3676); a bare "--" is often just a separator in the content
+    re.compile(r'^-- \r?$'),
+    re.compile(r'^Sent from my \w+', re.IGNORECASE),
+]
+
+
+class _HTMLTextExtractor(HTMLParser):
+    """Collects the visible text of an HTML document"""
+
+    BLOCK_TAGS = {'p', 'div', 'br', 'tr', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'table'}
+    SKIP_TAGS = {'script', 'style', 'head', 'title'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self.chunks.append(data)
+
+
+def html_to_text(html):
+    """Convert an HTML body to plain text"""
+    parser = _HTMLTextExtractor()
+    parser.feed(html)
+    parser.close()
+    text = ''.join(parser.chunks)
+    # Collapse the whitespace HTML layout leaves behind
+    text = re.sub(r'[ \t\r\f\v]+', ' ', text)
+    text = re.sub(r' *\n *', '\n', text)
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+
+def strip_quoted_text(text):
+    """Remove quoted reply chains and signatures from a plain text body"""
+    lines = text.splitlines()
+    kept = []
+
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        # Gmail sometimes wraps "On ... wrote:" over two lines
+        joined = f"{stripped} {lines[i + 1].strip()}" if i + 1 < len(lines) else stripped
+        if any(p.match(stripped) or p.match(joined) for p in QUOTE_HEADER_PATTERNS):
+            break
+        if any(p.match(line) for p in SIGNATURE_PATTERNS):
+            break
+        if stripped.startswith('>'):
+            continue
+        kept.append(line)
+
+    result = '\n'.join(kept).strip()
+    # If the whole email was a quote, keep it rather than sending nothing
+    return result or text.strip()
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text to roughly max_tokens, preferring a word boundary"""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+
+    cut = text[:max_chars]
+    boundary = cut.rfind(' ', int(max_chars * 0.8))
+    if boundary > 0:
+        cut = cut[:boundary]
+    return cut.rstrip() + TRUNCATION_MARKER
+
+
+def _header(part, name):
+    return next((h['value'] for h in part.get('headers', []) if h['name'].lower() == name.lower()), None)
+
+
+def _charset(part):
+    content_type = _header(part, 'Content-Type') or ''
+    match = re.search(r'charset="?([\w.:-]+)"?', content_type, re.IGNORECASE)
+    return match.group(1) if match else 'utf-8'
+
+
+def _decode_part(part, max_bytes):
+    """Decode at most max_bytes of a part's base64url body without decoding the rest"""
+    data = part.get('body', {}).get('data')
+    if not data:
+        return ""
+
+    # Every 4 base64 characters hold 3 bytes
+    encoded = data[:-(-max_bytes // 3) * 4]
+    encoded += '=' * (-len(encoded) % 4)
+    raw = base64.urlsafe_b64decode(encoded)[:max_bytes]
+
+    try:
+        # A multibyte character cut at the budget boundary is simply dropped
+        return raw.decode(_charset(part), errors='ignore')
+    except LookupError:
+        return raw.decode('utf-8', errors='ignore')
+
+
+def _find_part(payload, mime_type):
+    """Depth-first search for the first non-attachment part of the given type"""
+    if payload.get('mimeType') == mime_type and not payload.get('filename'):
+        return payload
+    for part in payload.get('parts') or []:
+        found = _find_part(part, mime_type)
+        if found:
+            return found
+    return None
+
+
+def extract_body(payload, max_tokens):
+    """Extract a bounded, cleaned-up plain text body from a Gmail message payload.
+
+    Walks nested multipart/* parts, prefers text/plain over text/html, strips quoted
+    replies and signatures, and never decodes much more than the budget needs.
+    """
+    max_bytes = max_tokens * CHARS_PER_TOKEN * RAW_BUDGET_FACTOR
+
+    plain_part = _find_part(payload, 'text/plain')
+    if plain_part:
+        text = _decode_part(plain_part, max_bytes)
+    else:
+        html_part = _find_part(payload, 'text/html')
+        text = html_to_text(_decode_part(html_part, max_bytes)) if html_part else ""
+
+    return truncate_to_tokens(strip_quoted_text(text), max_tokens)
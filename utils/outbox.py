@@ -0,0 +1,111 @@
+import random
+import threading
+import time
+import traceback
+
+
+class OutboxDispatcher:
+    """Delivers queued outbox entries (see Database.enqueue_outbox) with retries.
+
+    Entries are claimed by kind, so the web server and the poller can share one outbox
+    while each only delivers the side effects it has handlers for. A failed delivery is
+    retried with exponential backoff and jitter; after max_attempts the entry is parked
+    as DEAD and on_dead is called so the caller can tell someone. With max_attempts=None
+    entries never give up and keep retrying every max_delay.
+
+    Delivery is at-least-once: a crash between the external call succeeding and the
+    entry being marked DONE means it runs again once its lease expires, so handlers
+    should do as little as possible after their one non-repeatable call.
+    """
+
+    def __init__(self, db, handlers, on_dead=None, max_attempts=8, base_delay=5.0,
+                 max_delay=900.0, poll_interval=5.0, batch_size=10, lease_seconds=120):
+        """
+        Args:
+            db: Database holding the outbox table
+            handlers: Maps kind -> handler(payload, idempotency_key); raising means retry
+            on_dead: Called as on_dead(kind, payload, error) when an entry gives up
+            max_attempts: Deliveries tried before an entry is parked as DEAD, or None to retry forever
+            base_delay: Seconds before the first retry, doubled on each further failure
+            max_delay: Upper bound on the retry delay
+            poll_interval: Seconds between checks for due entries when not woken
+            batch_size: Entries claimed at a time
+            lease_seconds: How long a claimed entry stays reserved for this process
+        """
+        self.db = db
+        self.handlers = handlers
+        self.on_dead = on_dead
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.stats = {"delivered": 0, "retried": 0, "dead": 0}
+
+    def start(self):
+        """Start delivering in a background thread (also picks up entries left by a previous run)"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+            self._thread.start()
+        return self
+
+    def wake(self):
+        """Deliver newly queued entries now instead of at the next poll"""
+        self._wake.set()
+
+    def dispatch_due(self):
+        """Deliver every entry that is currently due. Returns the number attempted."""
+        attempted = 0
+        while True:
+            entries = self.db.claim_outbox(list(self.handlers), self.batch_size, self.lease_seconds)
+            if not entries:
+                return attempted
+            for entry in entries:
+                self._deliver(entry)
+            attempted += len(entries)
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                self.dispatch_due()
+            except Exception as e:
+                print(f"❌ Outbox dispatcher error: {e}")
+                traceback.print_exc()
+            self._wake.wait(self.poll_interval)
+
+    def _deliver(self, entry):
+        kind, payload = entry['kind'], entry['payload']
+        try:
+            self.handlers[kind](payload, entry['idempotency_key'])
+        except Exception as e:
+            attempts = entry['attempts'] + 1
+            if self.max_attempts is not None and attempts >= self.max_attempts:
+                self.db.fail_outbox(entry['id'], e)
+                self._count("dead")
+                print(f"❌ Outbox {kind} {entry['idempotency_key']} gave up after {attempts} attempts: {e}")
+                if self.on_dead:
+                    try:
+                        self.on_dead(kind, payload, e)
+                    except Exception as dead_error:
+                        print(f"❌ Outbox on_dead handler failed: {dead_error}")
+                return
+
+            # Capping the exponent keeps the arithmetic bounded for entries retrying forever
+            delay = min(self.max_delay, self.base_delay * 2 ** min(attempts - 1, 30))
+            delay *= random.uniform(0.8, 1.2)
+            self.db.fail_outbox(entry['id'], e, retry_at=time.time() + delay)
+            self._count("retried")
+            print(f"⚠️ Outbox {kind} {entry['idempotency_key']} failed (attempt {attempts}), retrying in {delay:.0f}s: {e}")
+            return
+
+        self.db.complete_outbox(entry['id'])
+        self._count("delivered")
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
@@ -0,0 +1,152 @@
+import queue
+import threading
+import time
+import traceback
+
+# Marks the end of a stage's input
+_DONE = object()
+
+
+class Stage:
+    def __init__(self, name, handler, workers=1, fan_out=False, batch_size=1, batch_linger=0.0):
+        """A pipeline stage.
+
+        Args:
+            name: Name used in logs and stats
+            handler: Called with each input item. Returns the output item, or None to drop it.
+                With fan_out=True it returns an iterable of output items instead.
+                With batch_size > 1 it is called with a list of items.
+            workers: Number of threads running this stage concurrently
+            fan_out: Whether the handler produces several outputs per input
+            batch_size: Maximum number of items handed to the handler at once
+            batch_linger: Seconds to wait for more items before running a partial batch
+        """
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.fan_out = fan_out
+        self.batch_size = max(1, batch_size)
+        self.batch_linger = batch_linger
+
+
+class StagedPipeline:
+    """Runs items through a chain of stages, each with its own bounded queue and worker pool.
+
+    Stages are connected by bounded queues, so a slow stage blocks the ones feeding it
+    (backpressure) instead of letting work pile up in memory. An item only reaches a
+    stage once the previous stage is done with it, so side effects for one item keep
+    their order; different items run concurrently.
+    """
+
+    def __init__(self, stages, queue_size=20):
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def run(self, source):
+        """Feed every item from source through the stages and return the last stage's outputs.
+
+        source is consumed lazily on the calling thread, so it can itself be a slow
+        generator (e.g. paginated API calls) that overlaps with processing.
+        """
+        self._queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        self._remaining_workers = [stage.workers for stage in self.stages]
+        self._lock = threading.Lock()
+        self._results = []
+        self.last_error = None
+        self.stats = {
+            stage.name: {"processed": 0, "errors": 0, "busy_seconds": 0.0}
+            for stage in self.stages
+        }
+
+        threads = []
+        for index, stage in enumerate(self.stages):
+            for n in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._worker, args=(index,), name=f"{stage.name}-{n}", daemon=True
+                )
+                thread.start()
+                threads.append(thread)
+
+        try:
+            for item in source:
+                # Blocks while the first stage is saturated
+                self._queues[0].put(item)
+        finally:
+            # Always shut the workers down, even if the source failed
+            for _ in range(self.stages[0].workers):
+                self._queues[0].put(_DONE)
+            for thread in threads:
+                thread.join()
+
+        return self._results
+
+    @property
+    def errors(self):
+        """Total number of items that raised in any stage during the last run"""
+        return sum(stage_stats["errors"] for stage_stats in self.stats.values())
+
+    def _worker(self, index):
+        stage = self.stages[index]
+        inbox = self._queues[index]
+        stats = self.stats[stage.name]
+
+        done = False
+        while not done:
+            item = inbox.get()
+            if item is _DONE:
+                break
+            if stage.batch_size > 1:
+                item, done = self._collect_batch(stage, inbox, item)
+
+            started = time.monotonic()
+            try:
+                if stage.fan_out:
+                    for output in stage.handler(item) or []:
+                        self._emit(index, output)
+                else:
+                    self._emit(index, stage.handler(item))
+                with self._lock:
+                    stats["processed"] += len(item) if stage.batch_size > 1 else 1
+            except Exception as e:
+                print(f"❌ Pipeline stage '{stage.name}' failed: {e}")
+                traceback.print_exc()
+                with self._lock:
+                    stats["errors"] += 1
+                    self.last_error = e
+            finally:
+                with self._lock:
+                    stats["busy_seconds"] += time.monotonic() - started
+
+        # The last worker of a stage to finish closes the next stage's input
+        with self._lock:
+            self._remaining_workers[index] -= 1
+            stage_finished = self._remaining_workers[index] == 0
+        if stage_finished and index + 1 < len(self.stages):
+            for _ in range(self.stages[index + 1].workers):
+                self._queues[index + 1].put(_DONE)
+
+    def _collect_batch(self, stage, inbox, first_item):
+        """Gather up to batch_size items, waiting at most batch_linger for stragglers.
+
+        Returns (batch, done) where done means the end-of-input marker was consumed.
+        """
+        batch = [first_item]
+        deadline = time.monotonic() + stage.batch_linger
+        while len(batch) < stage.batch_size:
+            try:
+                item = inbox.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is _DONE:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _emit(self, index, output):
+        if output is None:
+            return
+        if index + 1 < len(self.stages):
+            self._queues[index + 1].put(output)
+        else:
+            with self._lock:
+                self._results.append(output)
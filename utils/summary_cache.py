@@ -0,0 +1,107 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from email.utils import parseaddr
+
+# Parts of an email that change between otherwise identical alerts and newsletters
+_URL_QUERY = re.compile(r'(https?://[^\s?#]+)[?#]\S*')
+_UUID = re.compile(r'\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b')
+# Long tokens mixing letters and digits (tracking IDs, hashes); plain numbers are kept
+# since amounts and dates change what a summary should say
+_TOKEN_ID = re.compile(r'\b(?=[A-Za-z0-9_-]*\d)(?=[A-Za-z0-9_-]*[A-Za-z])[A-Za-z0-9_-]{20,}\b')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_email(sender, subject, body):
+    """Reduce an email to the parts that matter for its summary"""
+    address = parseaddr(sender)[1] or sender
+    parts = []
+    for text in (address, subject, body):
+        text = _URL_QUERY.sub(r'\1', text or "").lower()
+        text = _UUID.sub('<id>', text)
+        text = _TOKEN_ID.sub('<id>', text)
+        parts.append(_WHITESPACE.sub(' ', text).strip())
+    return "\x00".join(parts)
+
+
+class SummaryCache:
+    """Two-tier cache of email summaries keyed by a hash of the normalized email.
+
+    An in-process LRU answers repeats within a run; the summary_cache table keeps
+    summaries across restarts, with a TTL and a cap on the number of rows. Keys include
+    a namespace (model and prompt version) so changing either starts a fresh cache.
+    """
+
+    def __init__(self, db=None, namespace="", max_memory_entries=1024,
+                 ttl_seconds=30 * 24 * 60 * 60, max_db_entries=20000, prune_every=100):
+        """
+        Args:
+            db: Database for the persistent tier, or None for memory only
+            namespace: Mixed into every key, e.g. the model and prompt version
+            max_memory_entries: Size of the in-process LRU
+            ttl_seconds: Age after which a stored summary is no longer used
+            max_db_entries: Rows kept in the summary_cache table
+            prune_every: Stores between evictions of the persistent tier
+        """
+        self.db = db
+        self.namespace = namespace
+        self.max_memory_entries = max_memory_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_db_entries = max_db_entries
+        self.prune_every = prune_every
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._stores_since_prune = 0
+        self.stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "evicted": 0}
+
+    def key(self, sender, subject, body):
+        normalized = normalize_email(sender, subject, body)
+        return hashlib.sha256(f"{self.namespace}\x00{normalized}".encode()).hexdigest()
+
+    def get(self, key):
+        """Return the cached summary for key, or None"""
+        with self._lock:
+            summary = self._memory.get(key)
+            if summary is not None:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return summary
+
+        summary = self.db.get_cached_summary(key, self.ttl_seconds) if self.db else None
+        with self._lock:
+            if summary is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["db_hits"] += 1
+        self._remember(key, summary)
+        return summary
+
+    def put(self, key, summary):
+        """Store a freshly generated summary in both tiers"""
+        self._remember(key, summary)
+        if not self.db:
+            return
+
+        self.db.set_cached_summary(key, summary)
+        with self._lock:
+            self._stores_since_prune += 1
+            prune = self._stores_since_prune >= self.prune_every
+            if prune:
+                self._stores_since_prune = 0
+        if prune:
+            evicted = self.db.prune_summary_cache(self.ttl_seconds, self.max_db_entries)
+            with self._lock:
+                self.stats["evicted"] += evicted
+
+    @property
+    def hit_rate(self):
+        lookups = self.stats["memory_hits"] + self.stats["db_hits"] + self.stats["misses"]
+        return (self.stats["memory_hits"] + self.stats["db_hits"]) / lookups if lookups else 0.0
+
+    def _remember(self, key, summary):
+        with self._lock:
+            self._memory[key] = summary
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)